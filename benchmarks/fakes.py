@@ -0,0 +1,118 @@
+"""
+Minimal stand-ins for the discord.py objects used by XpManager and Commands,
+so the storage can be benchmarked without a connection to Discord.
+"""
+from types import SimpleNamespace
+
+class HTTPException(Exception):
+    pass
+
+class Embed(object):
+    def __init__(self, title="", description="", color=None):
+        self.title = title
+        self.description = description
+        self.fields = []
+
+    def set_footer(self, text="", icon_url=None):
+        pass
+
+    def set_thumbnail(self, url=None):
+        pass
+
+    def add_field(self, name, value, inline=True):
+        self.fields.append((name, value))
+
+class Role(object):
+    def __init__(self, id, guild):
+        self.id = id
+        self.guild = guild
+        self.name = f"role {id}"
+        self.mention = f"<@&{id}>"
+
+class Member(object):
+    def __init__(self, id, guild, bot=False):
+        self.id = id
+        self.guild = guild
+        self.bot = bot
+        self.name = f"member {id}"
+        self.mention = f"<@!{id}>"
+        self.avatar_url = ""
+        self.roles = []
+        self.voice = None
+        self.guild_permissions = SimpleNamespace(administrator=True)
+
+    async def add_roles(self, *roles, reason=None):
+        for role in roles:
+            if role not in self.roles:
+                self.roles.append(role)
+
+    async def remove_roles(self, *roles, reason=None):
+        self.roles = [role for role in self.roles if role not in roles]
+
+class Channel(object):
+    def __init__(self, id, guild):
+        self.id = id
+        self.guild = guild
+        self.name = f"channel {id}"
+        self.members = []
+
+    async def send(self, content=None, embed=None):
+        pass
+
+class Guild(object):
+    def __init__(self, id, member_count, role_count=5):
+        self.id = id
+        self.icon_url = ""
+        self.members = [Member(id * 1000000 + index, self) for index in range(member_count)]
+        self.member_map = {member.id: member for member in self.members}
+        self.roles = [Role(id * 1000 + index, self) for index in range(role_count)]
+        self.role_map = {role.id: role for role in self.roles}
+        self.text_channel = Channel(id * 10 + 1, self)
+        self.voice_channel = Channel(id * 10 + 2, self)
+        self.voice_channels = [self.voice_channel]
+
+    def get_member(self, member_id):
+        return self.member_map.get(member_id)
+
+    def get_role(self, role_id):
+        return self.role_map.get(role_id)
+
+    async def fetch_roles(self):
+        return self.roles
+
+class Message(object):
+    def __init__(self, content, author):
+        self.content = content
+        self.author = author
+        self.guild = author.guild
+        self.channel = author.guild.text_channel
+        self.mentions = []
+        self.role_mentions = []
+
+    async def delete(self):
+        pass
+
+class VoiceState(object):
+    def __init__(self, channel=None, self_video=False):
+        self.channel = channel
+        self.self_video = self_video
+        self.afk = False
+        self.deaf = False
+        self.mute = False
+        self.self_deaf = False
+        self.self_mute = False
+
+class Clock(object):
+    def __init__(self, step):
+        """
+        A fake time function that advances by a fixed step on every call.
+        :param step: Seconds added per call.
+        """
+        self.now = 1637856744.0
+        self.step = step
+
+    def __call__(self):
+        self.now += self.step
+        return self.now
+
+discord = SimpleNamespace(Embed=Embed, Member=Member, HTTPException=HTTPException)
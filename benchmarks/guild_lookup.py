@@ -0,0 +1,42 @@
+"""
+Measures Database.get_guild against the linear search it replaced.
+Run from the repository root: python -m benchmarks.guild_lookup [guilds]
+"""
+import os
+import random
+import sys
+import tempfile
+from timeit import timeit
+from database import Database
+
+def scan(database, guild_id):
+    """
+    The former get_guild lookup: a search over every guild document.
+    :param database: The Database to search.
+    :param guild_id: The ID of the guild to find.
+    :return: The guild data.
+    """
+    return [guild for guild in database.main_shard.table.values() if guild["guild_id"] == guild_id][0]
+
+def main(guild_count):
+    """
+    Fills a temporary database with guilds and times random lookups with both methods.
+    :param guild_count: The number of guilds to create.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        database = Database(os.path.join(directory, "bot"), flush_interval=60)
+        guild_ids = [random.getrandbits(63) for _ in range(guild_count)]
+        for guild_id in guild_ids:
+            database.save_guild(guild_id)
+        lookups = [random.choice(guild_ids) for _ in range(10000)]
+
+        indexed = timeit(lambda: [database.get_guild(guild_id) for guild_id in lookups], number=1)
+        scanned = timeit(lambda: [scan(database, guild_id) for guild_id in lookups], number=1)
+        database.close()
+
+    print(f"{guild_count} guilds, {len(lookups)} lookups")
+    print(f"index: {indexed / len(lookups) * 1e6:8.2f} µs per lookup")
+    print(f"scan:  {scanned / len(lookups) * 1e6:8.2f} µs per lookup ({scanned / indexed:.0f}x slower)")
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,78 @@
+"""
+Measures the memory of loaded member records: the former JSON dicts against MemberRecord slots.
+Run from the repository root: python -m benchmarks.member_memory [members]
+"""
+import gc
+import json
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+from database import Shard
+
+def write_guild(path, member_count):
+    """
+    Writes a database file with one guild and random member values.
+    :param path: The path of the file.
+    :param member_count: The number of members to create.
+    """
+    members = {}
+    for doc_id in range(1, member_count + 1):
+        members[str(doc_id)] = {
+            "guild_id": 899237543281836062,
+            "member_id": random.getrandbits(63),
+            "xp": random.random() * 1000,
+            "last_counted_message_time": 1637856744.5068839 + doc_id,
+            "last_voice_checkpoint": None
+        }
+    guild = {"guild_id": 899237543281836062, "prefix": "!", "roles": {}, "rickroll_members": "", "rickroll_roles": ""}
+    with open(path, "w") as handle:
+        json.dump({"_default": {"1": guild}, "members": members}, handle)
+
+def load_dicts(path):
+    """
+    Loads the file the way members were kept before: the parsed JSON dicts plus an index by member ID.
+    :param path: The path of the file.
+    :return: The loaded data.
+    """
+    with open(path) as handle:
+        data = json.load(handle)
+    index = {}
+    for member in data["members"].values():
+        index.setdefault(member["guild_id"], {})[member["member_id"]] = member
+    return data, index
+
+def measure(load, path):
+    """
+    Measures the memory still allocated after loading a file.
+    :param load: The function loading the file.
+    :param path: The path of the file.
+    :return: The allocated bytes.
+    """
+    gc.collect()
+    tracemalloc.start()
+    loaded = load(path)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del loaded
+    return size
+
+def main(member_count):
+    """
+    Writes a guild with the given number of members and compares the memory of both representations.
+    :param member_count: The number of members to create.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "guild.json")
+        write_guild(path, member_count)
+        dicts = measure(load_dicts, path)
+        records = measure(Shard, path)
+
+    print(f"{member_count} members")
+    print(f"dict records:  {dicts / 2 ** 20:7.1f} MiB ({dicts / member_count:.0f} bytes per member)")
+    print(f"MemberRecord:  {records / 2 ** 20:7.1f} MiB ({records / member_count:.0f} bytes per member)")
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
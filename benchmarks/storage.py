@@ -0,0 +1,219 @@
+"""
+Benchmarks the storage backends under the load of the bot's event handlers.
+Every backend gets a synthetic guild of each size and is driven through XpManager and Commands
+with stand-in discord objects. For each event type the throughput, the latency percentiles
+and the bytes written to disk per event are reported; for loading, the size of the stored files.
+Run from the repository root: python -m benchmarks.storage --members 10 1000 100000
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+from time import perf_counter
+from benchmarks.fakes import Clock, Guild, Message, VoiceState, discord
+from commands import Commands
+from database import Database
+from sqlite_database import SqliteDatabase
+from xp_system import XpManager
+
+BACKENDS = {
+    "json": lambda name: Database(name),
+    "json-cached": lambda name: Database(name, flush_interval=30),
+    "json-journal": lambda name: Database(name, flush_interval=30, journal=True),
+    "json-sharded": lambda name: Database(name, sharded=True),
+    "json-compressed": lambda name: Database(name, flush_interval=30, compress=True),
+    "json-mapped": lambda name: Database(name, flush_interval=30, mapped=True),
+    "json-shared": lambda name: Database(name, shared=True),
+    "sqlite": lambda name: SqliteDatabase(name),
+    "sqlite-batched": lambda name: SqliteDatabase(name, flush_interval=30),
+}
+
+def written_bytes():
+    """
+    Returns the number of bytes this process has written so far, including the storage worker thread.
+    :return: The byte count, or None where /proc/self/io is not available.
+    """
+    try:
+        with open("/proc/self/io") as handle:
+            for line in handle:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+def stored_bytes(directory):
+    """
+    Returns the size of all files in a directory and its subdirectories.
+    :param directory: The path of the directory.
+    :return: The size in bytes.
+    """
+    return sum(os.path.getsize(os.path.join(path, file_name)) for path, _, file_names in os.walk(directory) for file_name in file_names)
+
+def percentile(values, fraction):
+    """
+    Returns a percentile of a list of values.
+    :param values: The measured values.
+    :param fraction: The percentile as a fraction, e.g. 0.99.
+    :return: The value below which the given fraction of values lies.
+    """
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def settle(database):
+    """
+    Waits until everything the database has queued is on disk.
+    :param database: The database.
+    """
+    writer = getattr(database, "writer", None)
+    if writer is not None:
+        writer.wait()
+
+class Run(object):
+    def __init__(self, database, flush_every):
+        """
+        Drives one database through the benchmark events.
+        :param database: The database to benchmark.
+        :param flush_every: Events between the periodic flushes that autoflush would do.
+        """
+        self.database = database
+        self.flush_every = flush_every
+        self.flushes = 0
+
+    def periodic_flush(self):
+        """
+        Stands in for the autoflush task of databases with a flush interval:
+        flushes, and compacts the xp journal every tenth time.
+        """
+        if self.database.flush_interval is None:
+            return
+        self.flushes += 1
+        if getattr(self.database, "journal", None) is not None and self.flushes % 10 == 0:
+            self.database.compact()
+        else:
+            self.database.flush()
+
+    async def measure(self, event, count):
+        """
+        Runs an event a number of times and measures it.
+        :param event: A coroutine function taking the event index.
+        :param count: The number of events.
+        :return: A dict with ops/sec, p50 and p99 latency in microseconds and bytes written per event.
+        """
+        latencies = []
+        written = written_bytes()
+        start = perf_counter()
+        for index in range(count):
+            begin = perf_counter()
+            await event(index)
+            latencies.append(perf_counter() - begin)
+            if (index + 1) % self.flush_every == 0:
+                self.periodic_flush()
+        self.periodic_flush()
+        settle(self.database)
+        elapsed = perf_counter() - start
+        after = written_bytes()
+        return {
+            "ops": count / elapsed,
+            "p50": percentile(latencies, 0.5) * 1e6,
+            "p99": percentile(latencies, 0.99) * 1e6,
+            "bytes": None if written is None else (after - written) / count,
+        }
+
+def populate(database, guild):
+    """
+    Stores all members of the guild with some XP.
+    :param database: The database to fill.
+    :param guild: The fake guild.
+    """
+    with database.transaction(guild.id):
+        for member in guild.members:
+            database.change_in_member(member, "xp", random.random() * 1000)
+    database.close()
+
+async def benchmark(backend, member_count, event_count, flush_every):
+    """
+    Benchmarks one backend with one guild size.
+    :param backend: The name of the backend in BACKENDS.
+    :param member_count: The number of members of the guild.
+    :param event_count: The number of message and voice events.
+    :param flush_every: Events between periodic flushes.
+    :return: A dict mapping each event type to its measurements.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        name = os.path.join(directory, "bot")
+        guild = Guild(1, member_count)
+        populate(BACKENDS[backend](name), guild)
+
+        start = perf_counter()
+        database = BACKENDS[backend](name)
+        elapsed = perf_counter() - start
+        results = {"load": {"ops": 1 / elapsed, "p50": elapsed * 1e6, "p99": None, "bytes": stored_bytes(directory)}}
+
+        xp_manager = XpManager(discord, database, Clock(61))
+        commands = Commands(discord, xp_manager)
+        run = Run(database, flush_every)
+        in_voice = VoiceState(guild.voice_channel)
+        not_in_voice = VoiceState()
+        # One member stays in voice, so every join starts two sessions and every leave ends them
+        guild.members[0].voice = in_voice
+        guild.voice_channel.members = guild.members[:1]
+        await xp_manager.index_voice_channels(guild)
+
+        async def message(index):
+            author = random.choice(guild.members)
+            await xp_manager.message_xp(Message("hello", author))
+            await commands.run(Message("hello", author))
+
+        async def voice(index):
+            member = guild.members[1 + index // 2 % (len(guild.members) - 1)]
+            if index % 2 == 0:
+                await xp_manager.voice_xp(member, not_in_voice, in_voice)
+            else:
+                await xp_manager.voice_xp(member, in_voice, not_in_voice)
+
+        async def ranklist(index):
+            await commands.run(Message("!ranklist", guild.members[0]))
+
+        async def no_xp(index):
+            await xp_manager.no_xp([guild])
+
+        results["message_xp"] = await run.measure(message, event_count)
+        results["voice_xp"] = await run.measure(voice, event_count)
+        results["ranklist"] = await run.measure(ranklist, max(1, event_count // 100))
+        results["no_xp"] = await run.measure(no_xp, 1)
+        database.close()
+    return results
+
+def format_number(value, digits=0):
+    """
+    Formats a measurement for the result table.
+    :param value: The value, or None.
+    :param digits: The number of decimal places.
+    :return: The formatted value.
+    """
+    return "-" if value is None else f"{value:,.{digits}f}"
+
+def main():
+    """
+    Parses the command line, runs all benchmarks and prints the result table.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the bot's storage backends.")
+    parser.add_argument("--members", type=int, nargs="+", default=[10, 1000], help="guild sizes to test")
+    parser.add_argument("--events", type=int, default=1000, help="message and voice events per run")
+    parser.add_argument("--flush-every", type=int, default=100, help="events between periodic flushes")
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=list(BACKENDS), help="backends to test")
+    arguments = parser.parse_args()
+
+    print(f"{'backend':<16}{'members':>9}  {'event':<11}{'ops/sec':>12}{'p50 µs':>12}{'p99 µs':>12}{'bytes/event':>14}")
+    for member_count in arguments.members:
+        for backend in arguments.backends:
+            results = asyncio.run(benchmark(backend, member_count, arguments.events, arguments.flush_every))
+            for event, result in results.items():
+                print(
+                    f"{backend:<16}{member_count:>9}  {event:<11}{format_number(result['ops'], 1):>12}"
+                    f"{format_number(result['p50']):>12}{format_number(result['p99']):>12}{format_number(result['bytes']):>14}"
+                )
+
+if __name__ == "__main__":
+    main()
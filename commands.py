@@ -1,3 +1,5 @@
+from metrics import STATS
+
 class Commands(object):
     """
     A class handling parsing of commands, mentions (members/roles), and
@@ -14,6 +16,7 @@ class Commands(object):
         self.discord = discord
         self.xp_manager = xp_manager
         self.database = xp_manager.database
+        self.prefixes = {}  # Cached prefix per guild ID, updated by "prefix set"
 
     # Class-wide properties used across methods
     message = None         # The current message being processed
@@ -311,24 +314,25 @@ class Commands(object):
             if m.startswith("<@&")
         ]
 
-        rickroll_members = self.database.get_from_guild(self.message.guild.id, "rickroll_members").split()
-        rickroll_roles = self.database.get_from_guild(self.message.guild.id, "rickroll_roles").split()
-
-        # Add or remove targets accordingly
-        if mode == "append":
-            for mid in target_member_ids:
-                if mid not in rickroll_members:
-                    rickroll_members.append(mid)
-            for rid in target_role_ids:
-                if rid not in rickroll_roles:
-                    rickroll_roles.append(rid)
-        elif mode == "remove":
-            rickroll_members = [mid for mid in rickroll_members if mid not in target_member_ids]
-            rickroll_roles = [rid for rid in rickroll_roles if rid not in target_role_ids]
-
-        # Update database fields
-        self.database.change_in_guild(self.message.guild.id, "rickroll_members", self.reversed_split(rickroll_members))
-        self.database.change_in_guild(self.message.guild.id, "rickroll_roles", self.reversed_split(rickroll_roles))
+        with self.database.transaction(self.message.guild.id):
+            rickroll_members = self.database.get_from_guild(self.message.guild.id, "rickroll_members").split()
+            rickroll_roles = self.database.get_from_guild(self.message.guild.id, "rickroll_roles").split()
+
+            # Add or remove targets accordingly
+            if mode == "append":
+                for mid in target_member_ids:
+                    if mid not in rickroll_members:
+                        rickroll_members.append(mid)
+                for rid in target_role_ids:
+                    if rid not in rickroll_roles:
+                        rickroll_roles.append(rid)
+            elif mode == "remove":
+                rickroll_members = [mid for mid in rickroll_members if mid not in target_member_ids]
+                rickroll_roles = [rid for rid in rickroll_roles if rid not in target_role_ids]
+
+            # Update database fields in a single write
+            self.database.change_in_guild(self.message.guild.id, "rickroll_members", self.reversed_split(rickroll_members))
+            self.database.change_in_guild(self.message.guild.id, "rickroll_roles", self.reversed_split(rickroll_roles))
 
         # Send a generic reply
         reply = self.GuildEmbed("Targets updated.", "")
@@ -404,276 +408,314 @@ class Commands(object):
         else:
             await self.message.channel.send(embed=self.PermissionDeniedEmbed(member))
 
+    def get_prefix(self, guild_id):
+        """
+        Returns the prefix of a guild. Prefixes almost never change, so each one is read
+        from the database only once and then served from self.prefixes.
+        """
+        prefix = self.prefixes.get(guild_id)
+        if prefix is None:
+            prefix = self.prefixes[guild_id] = self.database.get_from_guild(guild_id, "prefix")
+        return prefix
+
     async def run(self, message):
         """
         The main entry point for this command system. 
         Called whenever the bot sees a message. If it starts with the guild prefix, 
         we parse the command and execute the corresponding actions.
         """
+        # Only messages starting with the guild prefix can be commands. Everything else is dropped here,
+        # before any other work; the prefix is read from the database at most once per guild (see get_prefix).
+        prefix = self.get_prefix(message.guild.id)
+        if not message.content.startswith(prefix):
+            return
+
         self.message = message
-        self.command = message.content
-        self.prefix = self.database.get_from_guild(message.guild.id, "prefix")
-
-        # Only proceed if the message actually starts with the prefix
-        if self.command.startswith(self.prefix):
-            self.command = self.command[len(self.prefix):]
-            self.interpreter = []
-
-            # Parse mentions, text, lists, and argument assignments
-            self.format_code(message)
-
-            # A nested "menu" system of possible commands
-            menu_system = {
-                "": {
-                    "xp": ({
-                        "add": [
-                            "Adds xp to a given member.",
-                            {"member": "The mention of the member you want to add xp to.", "amount": "The amount of xp you want to add."}
-                        ],
-                        "set": [
-                            "Sets xp of a given member.",
-                            {"member": "The mention of the member you want to set the xp to.", "amount": "The new xp value."}
-                        ]
-                    },),
-                    "prefix": ([
-                        "Changes the prefix.",
-                        {"new": "The new prefix."}
-                    ],),
-                    "rickroll": ({
-                        "add": [
-                            "Adds a member/role that will be rickrolled in the future, if it joins a call.",
-                            {"target": "The mention of the member/role you want to rickroll."}
-                        ],
-                        "remove": [
-                            "Removes a member/role, so won't be rickrolled anymore.",
-                            {"target": "The mention of the member/role you want to remove."}
-                        ],
-                        "get": [
-                            "Returns the rickroll targets.",
-                            {}
-                        ]
-                    },),
-                    "autoroles": {
-                        "set": ([
-                            "Sets the automatic roles.",
-                            {"data": "String with minimal xp and role mention in pairs: 'xp1 @Role xp2 @Role ...'."}
-                        ],),
-                        "get": [
-                            "Returns the automatic roles.",
-                            {}
-                        ]
-                    },
-                    "stats": [
-                        "Returns the stats of a given member.",
-                        {"member": "The mention of the member (you by default)."}
+        self.prefix = prefix
+        self.command = message.content[len(prefix):]
+        self.interpreter = []
+
+        # Parse mentions, text, lists, and argument assignments
+        self.format_code(message)
+
+        # A nested "menu" system of possible commands
+        menu_system = {
+            "": {
+                "xp": ({
+                    "add": [
+                        "Adds xp to a given member.",
+                        {"member": "The mention of the member you want to add xp to.", "amount": "The amount of xp you want to add."}
+                    ],
+                    "set": [
+                        "Sets xp of a given member.",
+                        {"member": "The mention of the member you want to set the xp to.", "amount": "The new xp value."}
+                    ]
+                },),
+                "prefix": ([
+                    "Changes the prefix.",
+                    {"new": "The new prefix."}
+                ],),
+                "rickroll": ({
+                    "add": [
+                        "Adds a member/role that will be rickrolled in the future, if it joins a call.",
+                        {"target": "The mention of the member/role you want to rickroll."}
+                    ],
+                    "remove": [
+                        "Removes a member/role, so won't be rickrolled anymore.",
+                        {"target": "The mention of the member/role you want to remove."}
                     ],
-                    "ranklist": [
-                        "Returns a ranklist with all xp of this guild's members.",
+                    "get": [
+                        "Returns the rickroll targets.",
                         {}
                     ]
-                }
+                },),
+                "autoroles": {
+                    "set": ([
+                        "Sets the automatic roles.",
+                        {"data": "String with minimal xp and role mention in pairs: 'xp1 @Role xp2 @Role ...'."}
+                    ],),
+                    "get": [
+                        "Returns the automatic roles.",
+                        {}
+                    ]
+                },
+                "stats": [
+                    "Returns the stats of a given member.",
+                    {"member": "The mention of the member (you by default)."}
+                ],
+                "ranklist": [
+                    "Returns a ranklist with all xp of this guild's members.",
+                    {}
+                ],
+                "dbstats": ([
+                    "Returns how often each event handler used the database and how long it took.",
+                    {}
+                ],)
             }
+        }
+
+        # "help" command to navigate the menu system
+        if self.check("help"):
+            interpreter = [""] + self.interpreter
+            path = ""
+            fine = True
+            while interpreter and fine:
+                key = interpreter[0]
+                interpreter = interpreter[1:]
+                fine = key in menu_system.keys()
+                if fine:
+                    path += " " + key
+                    menu_system = menu_system[key]
+                    if isinstance(menu_system, tuple):
+                        # If we encounter a tuple, it's an admin-only branch
+                        fine = message.author.guild_permissions.administrator
+                        menu_system = menu_system[0]
+            path = path.strip()
+            if path:
+                path = path[1:] if len(path) > 1 else path
+
+            if isinstance(menu_system, dict):
+                # Show submenus
+                menus = []
+                admin_menus = []
+                for k in menu_system.keys():
+                    if isinstance(menu_system[k], tuple):
+                        admin_menus.append(k)
+                    else:
+                        menus.append(k)
+                await message.channel.send(embed=self.MenuHelpEmbed(path, menus, admin_menus))
+            elif isinstance(menu_system, list):
+                # It's a command, show details
+                description, arguments = menu_system
+                await message.channel.send(embed=self.CommandHelpEmbed(path, description, arguments))
+
+        # Stats command
+        elif self.check_and_assign("stats", ["member"], {"member": message.author}):
+            mention = self.needed["member"]
+            if isinstance(mention, self.discord.Member):
+                member = mention
+            else:
+                member = self.get_member_by_mention(mention)
+            if member is not None:
+                reply = self.MemberEmbed(member, "Stats", "for " + member.name)
+                xp = self.xp_manager.calculate_xp(member)
+                reply.add_field(name="XP", value=str(xp))
+                await message.channel.send(embed=reply)
 
-            # "help" command to navigate the menu system
-            if self.check("help"):
-                interpreter = [""] + self.interpreter
-                path = ""
-                fine = True
-                while interpreter and fine:
-                    key = interpreter[0]
-                    interpreter = interpreter[1:]
-                    fine = key in menu_system.keys()
-                    if fine:
-                        path += " " + key
-                        menu_system = menu_system[key]
-                        if isinstance(menu_system, tuple):
-                            # If we encounter a tuple, it's an admin-only branch
-                            fine = message.author.guild_permissions.administrator
-                            menu_system = menu_system[0]
-                path = path.strip()
-                if path:
-                    path = path[1:] if len(path) > 1 else path
-
-                if isinstance(menu_system, dict):
-                    # Show submenus
-                    menus = []
-                    admin_menus = []
-                    for k in menu_system.keys():
-                        if isinstance(menu_system[k], tuple):
-                            admin_menus.append(k)
-                        else:
-                            menus.append(k)
-                    await message.channel.send(embed=self.MenuHelpEmbed(path, menus, admin_menus))
-                elif isinstance(menu_system, list):
-                    # It's a command, show details
-                    description, arguments = menu_system
-                    await message.channel.send(embed=self.CommandHelpEmbed(path, description, arguments))
-
-            # Stats command
-            elif self.check_and_assign("stats", ["member"], {"member": message.author}):
-                mention = self.needed["member"]
-                if isinstance(mention, self.discord.Member):
-                    member = mention
-                else:
-                    member = self.get_member_by_mention(mention)
+        # Ranklist command
+        elif self.check_and_assign("ranklist"):
+            xp_to_members = {}
+            for mid, stored_xp in self.database.get_member_xp(message.guild.id):
+                member = message.guild.get_member(mid)
                 if member is not None:
-                    reply = self.MemberEmbed(member, "Stats", "for " + member.name)
-                    xp = self.xp_manager.calculate_xp(member)
-                    reply.add_field(name="XP", value=str(xp))
+                    xp_val = self.xp_manager.calculate_xp(member, stored_xp)
+                    if xp_val != 0:
+                        xp_to_members.setdefault(xp_val, []).append(member)
+            xps = sorted(xp_to_members.keys(), reverse=True)
+            reply = self.GuildEmbed("Ranklist", "Here is the server-wide ranklist:")
+            reply.add_field(name="Σ", value=str(sum(xps)) if xps else "0", inline=False)
+            rank = 1
+            for xp_val in xps:
+                for mem in xp_to_members[xp_val]:
+                    reply.add_field(name=f"{rank} - {mem.name}", value=str(xp_val), inline=False)
+                rank += len(xp_to_members[xp_val])
+            await message.channel.send(embed=reply)
+
+        # Database stats command
+        elif self.check_and_assign("dbstats"):
+            if await self.is_admin(message.author):
+                reply = self.StandardEmbed("Database stats", STATS.summary())
+                gauges = STATS.gauge_rows()
+                for name, text in gauges:
+                    reply.add_field(name=name, value=text, inline=False)
+                # Embeds hold at most 25 fields
+                for handler, operation, calls, seconds, read, written in STATS.rows()[:25 - len(gauges)]:
+                    reply.add_field(
+                        name=f"{handler} - {operation}",
+                        value=f"{calls} calls, {seconds * 1000:.1f} ms, {read} bytes read, {written} bytes written",
+                        inline=False
+                    )
+                await message.channel.send(embed=reply)
+
+        # Autoroles command
+        elif self.check("autoroles"):
+            try:
+                if self.check_and_assign("set", ["data"]):
+                    data = self.needed["data"]
+                    splitted = data.split()
+                    min_role_xp = {}
+                    if len(splitted) > 1:
+                        # Build a dict from pairs: xp, mention
+                        # e.g. "100 @Role 200 @AnotherRole"
+                        for i in range(0, len(splitted), 2):
+                            xp_val = splitted[i]
+                            role_mention = splitted[i + 1]
+                            if xp_val.isnumeric():
+                                min_role_xp[role_mention] = int(xp_val)
+
+                    all_roles = await message.guild.fetch_roles()
+                    roles = {}
+                    # Map the mention -> role.id, keyed by the xp
+                    for role in all_roles:
+                        if role.mention in min_role_xp.keys():
+                            xp_key = min_role_xp[role.mention]
+                            roles[str(xp_key)] = role.id
+
+                    self.database.change_in_guild(message.guild.id, "roles", roles)
+                    reply = self.GuildEmbed("Autoroles set.", "The autoroles have been set successfully.")
                     await message.channel.send(embed=reply)
 
-            # Ranklist command
-            elif self.check_and_assign("ranklist"):
-                members_data = self.database.get_from_guild(message.guild.id, "members")
-                member_ids = [int(mid) for mid in list(members_data.keys())]
-                xp_to_members = {}
-                for mid in member_ids:
-                    member = message.guild.get_member(mid)
+                elif self.check_and_assign("get"):
+                    roles = self.database.get_from_guild(message.guild.id, "roles")
+                    min_xp_list = sorted((int(x) for x in roles.keys()), reverse=True)
+                    reply = self.GuildEmbed("Autoroles", "The automatic roles for this server.")
+                    for min_xp in min_xp_list:
+                        rid = roles[str(min_xp)]
+                        r = message.guild.get_role(rid)
+                        reply.add_field(name=str(min_xp), value=r.name, inline=False)
+                    await message.channel.send(embed=reply)
+            except:
+                await message.channel.send(embed=self.SyntaxErrorEmbed())
+
+        # XP commands
+        elif self.check("xp"):
+            if await self.is_admin(message.author):
+                if self.check_and_assign("add", ["member", "amount"]):
+                    member_mention = self.needed["member"]
+                    member = self.get_member_by_mention(member_mention)
                     if member is not None:
-                        xp_val = self.xp_manager.calculate_xp(member)
-                        if xp_val != 0:
-                            xp_to_members.setdefault(xp_val, []).append(member)
-                xps = sorted(xp_to_members.keys(), reverse=True)
-                reply = self.GuildEmbed("Ranklist", "Here is the server-wide ranklist:")
-                reply.add_field(name="Σ", value=str(sum(xps)) if xps else "0", inline=False)
-                rank = 1
-                for xp_val in xps:
-                    for mem in xp_to_members[xp_val]:
-                        reply.add_field(name=f"{rank} - {mem.name}", value=str(xp_val), inline=False)
-                    rank += len(xp_to_members[xp_val])
-                await message.channel.send(embed=reply)
+                        amount = self.needed["amount"]
+
+                        # Convert amount to float (could be negative)
+                        if amount.isnumeric():
+                            amount = float(amount)
+                        elif amount.startswith("-") and amount[1:].isnumeric():
+                            amount = float(amount)
 
-            # Autoroles command
-            elif self.check("autoroles"):
-                try:
-                    if self.check_and_assign("set", ["data"]):
-                        data = self.needed["data"]
-                        splitted = data.split()
-                        min_role_xp = {}
-                        if len(splitted) > 1:
-                            # Build a dict from pairs: xp, mention
-                            # e.g. "100 @Role 200 @AnotherRole"
-                            for i in range(0, len(splitted), 2):
-                                xp_val = splitted[i]
-                                role_mention = splitted[i + 1]
-                                if xp_val.isnumeric():
-                                    min_role_xp[role_mention] = int(xp_val)
-
-                        all_roles = await message.guild.fetch_roles()
-                        roles = {}
-                        # Map the mention -> role.id, keyed by the xp
-                        for role in all_roles:
-                            if role.mention in min_role_xp.keys():
-                                xp_key = min_role_xp[role.mention]
-                                roles[str(xp_key)] = role.id
-
-                        self.database.change_in_guild(message.guild.id, "roles", roles)
-                        reply = self.GuildEmbed("Autoroles set.", "The autoroles have been set successfully.")
-                        await message.channel.send(embed=reply)
-
-                    elif self.check_and_assign("get"):
-                        roles = self.database.get_from_guild(message.guild.id, "roles")
-                        min_xp_list = sorted((int(x) for x in roles.keys()), reverse=True)
-                        reply = self.GuildEmbed("Autoroles", "The automatic roles for this server.")
-                        for min_xp in min_xp_list:
-                            rid = roles[str(min_xp)]
-                            r = message.guild.get_role(rid)
-                            reply.add_field(name=str(min_xp), value=r.name, inline=False)
-                        await message.channel.send(embed=reply)
-                except:
-                    await message.channel.send(embed=self.SyntaxErrorEmbed())
-
-            # XP commands
-            elif self.check("xp"):
-                if await self.is_admin(message.author):
-                    if self.check_and_assign("add", ["member", "amount"]):
-                        member_mention = self.needed["member"]
-                        member = self.get_member_by_mention(member_mention)
-                        if member is not None:
-                            amount = self.needed["amount"]
+                        changed = False
+                        with self.database.transaction(message.guild.id):
                             old_xp = int(self.database.get_from_member(member, "xp"))
                             old_xp_str = str(self.xp_manager.calculate_xp(member))
+                            if isinstance(amount, float) and old_xp + amount >= 0:
+                                self.database.change_in_member(member, "xp", old_xp + amount)
+                                new_xp = self.xp_manager.calculate_xp(member)
+                                changed = True
+
+                        if changed:
+                            reply = self.MemberEmbed(
+                                member,
+                                "XP changed.",
+                                f"Changed xp of {member.mention} from {old_xp_str} to {new_xp}."
+                            )
+                            await message.channel.send(embed=reply)
 
-                            # Convert amount to float (could be negative)
-                            if amount.isnumeric():
-                                amount = float(amount)
-                            elif amount.startswith("-") and amount[1:].isnumeric():
-                                amount = float(amount)
-
-                            if isinstance(amount, float):
-                                if old_xp + amount >= 0:
-                                    self.database.change_in_member(member, "xp", old_xp + amount)
-                                    new_xp = self.xp_manager.calculate_xp(member)
-                                    reply = self.MemberEmbed(
-                                        member,
-                                        "XP changed.",
-                                        f"Changed xp of {member.mention} from {old_xp_str} to {new_xp}."
-                                    )
-                                    await message.channel.send(embed=reply)
-
-                    elif self.check_and_assign("set", ["member", "amount"]):
-                        member_mention = self.needed["member"]
-                        member = self.get_member_by_mention(member_mention)
-                        if member is not None:
-                            amount = self.needed["amount"]
-                            if amount.isnumeric():
-                                xp_val = float(amount)
-                                if xp_val >= 0:
+                elif self.check_and_assign("set", ["member", "amount"]):
+                    member_mention = self.needed["member"]
+                    member = self.get_member_by_mention(member_mention)
+                    if member is not None:
+                        amount = self.needed["amount"]
+                        if amount.isnumeric():
+                            xp_val = float(amount)
+                            if xp_val >= 0:
+                                with self.database.transaction(message.guild.id):
                                     old_xp = self.xp_manager.calculate_xp(member)
                                     self.database.change_in_member(member, "xp", xp_val)
+                                    self.xp_manager.reset_pending_xp(member)
                                     new_xp = self.xp_manager.calculate_xp(member)
-                                    reply = self.MemberEmbed(
-                                        member,
-                                        "XP changed.",
-                                        f"Changed xp of {member.mention} from {old_xp} to {new_xp}."
-                                    )
-                                    await message.channel.send(embed=reply)
-
-            # Prefix change
-            elif self.check_and_assign("prefix", ["new"]):
-                if await self.is_admin(message.author):
-                    new = self.needed["new"]
-                    if isinstance(new, str):
+                                reply = self.MemberEmbed(
+                                    member,
+                                    "XP changed.",
+                                    f"Changed xp of {member.mention} from {old_xp} to {new_xp}."
+                                )
+                                await message.channel.send(embed=reply)
+
+        # Prefix change
+        elif self.check_and_assign("prefix", ["new"]):
+            if await self.is_admin(message.author):
+                new = self.needed["new"]
+                if isinstance(new, str):
+                    with self.database.transaction(message.guild.id):
                         self.database.change_in_guild(message.guild.id, "prefix", new)
-                        reply = self.GuildEmbed("Prefix changed.", f"{self.prefix} --> {new}")
-                        await message.channel.send(embed=reply)
-
-            # Rickroll commands
-            elif self.check("rickroll"):
-                # Show current targets
-                if self.check_and_assign("get"):
-                    rickroll_members = self.database.get_from_guild(message.guild.id, "rickroll_members").split()
-                    rickroll_roles = self.database.get_from_guild(message.guild.id, "rickroll_roles").split()
-
-                    role_names = ""
-                    member_names = ""
-                    for rid in rickroll_roles:
-                        role_obj = message.guild.get_role(int(rid))
-                        if role_obj is not None:
-                            role_names += role_obj.name + "\n"
-                    for mid in rickroll_members:
-                        mem_obj = message.guild.get_member(int(mid))
-                        if mem_obj is not None:
-                            member_names += mem_obj.name + "\n"
-
-                    if not role_names:
-                        role_names = "-"
-                    if not member_names:
-                        member_names = "-"
-
-                    reply = self.GuildEmbed("Targets", "Here are the rickroll targets:")
-                    reply.add_field(name="Roles", value=role_names)
-                    reply.add_field(name="Members", value=member_names)
+                    self.prefixes[message.guild.id] = new
+                    reply = self.GuildEmbed("Prefix changed.", f"{self.prefix} --> {new}")
                     await message.channel.send(embed=reply)
 
-                elif await self.is_admin(message.author):
-                    # Add
-                    if self.check_and_assign("add", ["targets"]):
-                        await self.update_rickroll_targets("append")
+        # Rickroll commands
+        elif self.check("rickroll"):
+            # Show current targets
+            if self.check_and_assign("get"):
+                rickroll_members = self.database.get_from_guild(message.guild.id, "rickroll_members").split()
+                rickroll_roles = self.database.get_from_guild(message.guild.id, "rickroll_roles").split()
+
+                role_names = ""
+                member_names = ""
+                for rid in rickroll_roles:
+                    role_obj = message.guild.get_role(int(rid))
+                    if role_obj is not None:
+                        role_names += role_obj.name + "\n"
+                for mid in rickroll_members:
+                    mem_obj = message.guild.get_member(int(mid))
+                    if mem_obj is not None:
+                        member_names += mem_obj.name + "\n"
+
+                if not role_names:
+                    role_names = "-"
+                if not member_names:
+                    member_names = "-"
+
+                reply = self.GuildEmbed("Targets", "Here are the rickroll targets:")
+                reply.add_field(name="Roles", value=role_names)
+                reply.add_field(name="Members", value=member_names)
+                await message.channel.send(embed=reply)
+
+            elif await self.is_admin(message.author):
+                # Add
+                if self.check_and_assign("add", ["targets"]):
+                    await self.update_rickroll_targets("append")
 
-                    # Remove
-                    elif self.check_and_assign("remove", ["targets"]):
-                        await self.update_rickroll_targets("remove")
+                # Remove
+                elif self.check_and_assign("remove", ["targets"]):
+                    await self.update_rickroll_targets("remove")
 
-            # Cleanup: delete the user's command message (if desired)
-            await message.delete()
+        # Cleanup: delete the user's command message (if desired)
+        await message.delete()
@@ -0,0 +1,550 @@
+"""
+Converts the bot's data between storage formats without loading a whole database into memory.
+
+    python convert.py bot.json bot.sqlite3
+    python convert.py bot.json bot --to sharded
+    python convert.py bot.sqlite3 bot.ndjson
+
+Formats: json (a single TinyDB-layout file, members nested or in their own table), sharded
+(a directory with one such file per guild), sqlite (the SqliteDatabase schema) and ndjson
+(one guild or member per line). Files are read guild by guild and member by member; after
+the conversion the member count and XP total of every guild are compared between source and target.
+A database using the xp journal has to be closed (and so compacted) before converting it.
+Compressed files (*.json.z) can be read but not written; the bot compresses a converted
+database itself when it is opened with compression. The same goes for members in memory-mapped
+tables (*.xp): they are read, written like all other members, and mapped again by the bot.
+"""
+import argparse
+import codecs
+import json
+import math
+import os
+import sqlite3
+import sys
+import zlib
+from collections import OrderedDict
+from contextlib import closing
+from database import MEMBER_DEFAULTS, guild_defaults
+from journal import HEADER
+from sqlite_database import GUILD_COLUMNS, MEMBER_COLUMNS, SCHEMA
+from storage import BLOCK_SIZE
+from xp_table import FIELDS, XpTable
+
+class CompressedText(object):
+    def __init__(self, path):
+        """
+        Initializes the CompressedText, which reads the text of a file compressed by JSONFileStorage block by block.
+        :param path: The path of the compressed file.
+        """
+        self.handle = open(path, "rb")
+        self.decompressor = zlib.decompressobj()
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+
+    def read(self, size=-1):
+        """
+        Decompresses the next block of the file.
+        :param size: Ignored; the text of one compressed block is returned at a time.
+        :return: The decompressed text, or "" at the end of the file.
+        """
+        while True:
+            block = self.handle.read(BLOCK_SIZE)
+            if not block:
+                return self.decoder.decode(self.decompressor.flush(), final=True)
+            text = self.decoder.decode(self.decompressor.decompress(block))
+            if text:
+                return text
+
+    def close(self):
+        """
+        Closes the file.
+        """
+        self.handle.close()
+
+def open_text(path):
+    """
+    Opens a database file for reading text, decompressing it if its path ends in ".z".
+    :param path: The path of the file.
+    :return: The open file.
+    """
+    if path.endswith(".z"):
+        return CompressedText(path)
+    return open(path, encoding="utf-8")
+
+class JsonStream(object):
+    def __init__(self, handle, chunk_size=65536):
+        """
+        Initializes the JsonStream, which parses a JSON document piece by piece from a file.
+        Objects can be walked key by key with items, everything else is read whole with value.
+        :param handle: The open text file.
+        :param chunk_size: The number of characters read at once.
+        """
+        self.handle = handle
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """
+        Reads the next chunk into the buffer, dropping what has already been parsed.
+        :return: False at the end of the file, else True.
+        """
+        chunk = self.handle.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        Skips whitespace and returns the next character.
+        :return: The next character, or "" at the end of the file.
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, char):
+        """
+        Consumes the next character, which has to be the given one.
+        :param char: The expected character.
+        """
+        if self.peek() != char:
+            raise ValueError(f"expected {char!r} but found {self.peek()!r}")
+        self.pos += 1
+
+    def value(self):
+        """
+        Parses the next complete JSON value, reading more of the file until it is complete.
+        :return: The parsed value.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            # A number at the end of the buffer might continue in the next chunk
+            if end == len(self.buffer) and not self.eof and self.fill():
+                continue
+            self.pos = end
+            return value
+
+    def items(self):
+        """
+        Walks the next JSON object key by key. The caller has to consume each key's value
+        (with value or another items) before asking for the next key.
+        :return: A generator of the object's keys.
+        """
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            char = self.peek()
+            self.expect(char)
+            if char == "}":
+                return
+            if char != ",":
+                raise ValueError(f"expected ',' or '}}' but found {char!r}")
+
+def read_mapped(path, guild_id):
+    """
+    Streams the members of a guild's memory-mapped XpTable in one sequential scan.
+    :param path: The path of the table file.
+    :param guild_id: The ID of the guild.
+    :return: A generator of member tuples like read_json.
+    """
+    with closing(XpTable(path)) as table:
+        for row in table.scan():
+            # The table stores NaN for values that are not set
+            yield "member", guild_id, row[0], {key: None if value != value else value for key, value in zip(FIELDS, row[1:])}
+
+def read_json(path, mapped_directory=None):
+    """
+    Streams the guilds and members of a single database file, including members kept in XpTables.
+    :param path: The path of the file.
+    :param mapped_directory: The directory of the guilds' XpTables <guild_id>.xp. By default the directory
+                             <name>.xp next to the file is used, if it exists.
+    :return: A generator of ("guild", guild_id, values) and ("member", guild_id, member_id, values) tuples.
+    """
+    if mapped_directory is None:
+        directory = os.path.splitext(path[:-2] if path.endswith(".z") else path)[0] + ".xp"
+        mapped_directory = directory if os.path.isdir(directory) else None
+    with closing(open_text(path)) as handle:
+        stream = JsonStream(handle)
+        if stream.peek() == "":
+            return
+        for table in stream.items():
+            if table == "_default":
+                for doc_id in stream.items():
+                    values = {}
+                    for key in stream.items():
+                        if key == "members":
+                            # Files from before members had their own table nest them in the guild
+                            if "guild_id" not in values:
+                                raise ValueError(f"guild {doc_id} in {path} lists its members before its guild_id")
+                            for member_id in stream.items():
+                                yield "member", values["guild_id"], int(member_id), stream.value()
+                        else:
+                            values[key] = stream.value()
+                    guild_id = values.pop("guild_id")
+                    yield "guild", guild_id, values
+                    if mapped_directory is not None:
+                        table_path = os.path.join(mapped_directory, str(guild_id) + ".xp")
+                        if os.path.exists(table_path):
+                            yield from read_mapped(table_path, guild_id)
+            elif table == "members":
+                for doc_id in stream.items():
+                    values = stream.value()
+                    yield "member", values.pop("guild_id"), values.pop("member_id"), values
+            else:
+                stream.value()
+
+def read_sharded(directory):
+    """
+    Streams the guilds and members of a directory with one database file per guild, compressed or not.
+    The XpTables of mapped members are in the same directory.
+    :param directory: The path of the directory.
+    :return: A generator of guild and member tuples like read_json.
+    """
+    file_names = sorted(file_name for file_name in os.listdir(directory) if file_name.endswith((".json", ".json.z")))
+    for file_name in file_names:
+        if file_name.endswith(".json") and file_name + ".z" in file_names:
+            raise ValueError(f"{directory} contains both {file_name} and {file_name}.z")
+    for file_name in file_names:
+        yield from read_json(os.path.join(directory, file_name), directory)
+
+def read_sqlite(path):
+    """
+    Streams the guilds and members of an SQLite database.
+    :param path: The path of the database file.
+    :return: A generator of guild and member tuples like read_json.
+    """
+    connection = sqlite3.connect(path)
+    try:
+        for row in connection.execute("SELECT guild_id, " + ", ".join(GUILD_COLUMNS) + " FROM guilds"):
+            values = dict(zip(GUILD_COLUMNS, row[1:]))
+            values["roles"] = json.loads(values["roles"])
+            yield "guild", row[0], values
+        for row in connection.execute("SELECT guild_id, member_id, " + ", ".join(MEMBER_COLUMNS) + " FROM members"):
+            yield "member", row[0], row[1], dict(zip(MEMBER_COLUMNS, row[2:]))
+    finally:
+        connection.close()
+
+def read_ndjson(path):
+    """
+    Streams the guilds and members of an NDJSON file.
+    :param path: The path of the file.
+    :return: A generator of guild and member tuples like read_json.
+    """
+    with open(path, encoding="utf-8") as handle:
+        for line in handle:
+            if line.strip():
+                values = json.loads(line)
+                if values.pop("type") == "guild":
+                    yield "guild", values.pop("guild_id"), values
+                else:
+                    yield "member", values.pop("guild_id"), values.pop("member_id"), values
+
+def member_document(guild_id, member_id, values):
+    """
+    Builds the stored document of a member, filling in defaults for missing values.
+    :param guild_id: The ID of the member's guild.
+    :param member_id: The ID of the member.
+    :param values: The member values.
+    :return: The member document.
+    """
+    document = {"guild_id": guild_id, "member_id": member_id}
+    for key, default in MEMBER_DEFAULTS.items():
+        document[key] = values.get(key, default)
+    return document
+
+def assemble(path, guilds, spool_paths):
+    """
+    Writes a database file in TinyDB's layout from guild entries and spooled member documents,
+    copying the members line by line. The file is written to a temporary name and then renamed.
+    :param path: The path of the file to write.
+    :param guilds: A list of (guild_id, values) pairs.
+    :param spool_paths: Files with one member document per line.
+    """
+    with open(path + ".tmp", "w", encoding="utf-8") as handle:
+        handle.write('{"_default": {')
+        for doc_id, (guild_id, values) in enumerate(guilds, 1):
+            guild = {"guild_id": guild_id}
+            guild.update(values)
+            handle.write((", " if doc_id > 1 else "") + json.dumps(str(doc_id)) + ": " + json.dumps(guild))
+        handle.write('}, "members": {')
+        doc_id = 0
+        for spool_path in spool_paths:
+            if os.path.exists(spool_path):
+                with open(spool_path, encoding="utf-8") as spool:
+                    for line in spool:
+                        doc_id += 1
+                        handle.write((", " if doc_id > 1 else "") + json.dumps(str(doc_id)) + ": " + line.rstrip("\n"))
+                os.remove(spool_path)
+        handle.write("}}")
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.replace(path + ".tmp", path)
+
+class JsonWriter(object):
+    def __init__(self, path):
+        """
+        Initializes the JsonWriter, which writes a single database file.
+        Members are spooled to a temporary file, since the guild table comes first in the file.
+        :param path: The path of the file to write.
+        """
+        self.path = path
+        self.guilds = OrderedDict()
+        self.spool_path = path + ".members.tmp"
+        self.spool = open(self.spool_path, "w", encoding="utf-8")
+
+    def write(self, event):
+        """
+        Adds a guild or member to the output.
+        :param event: A guild or member tuple as produced by the readers.
+        """
+        if event[0] == "guild":
+            self.guilds[event[1]] = event[2]
+        else:
+            self.guilds.setdefault(event[1], None)
+            self.spool.write(json.dumps(member_document(*event[1:])) + "\n")
+
+    def close(self):
+        """
+        Writes the file from the collected guilds and the spooled members.
+        """
+        self.spool.close()
+        guilds = [(guild_id, values or guild_defaults()) for guild_id, values in self.guilds.items()]
+        assemble(self.path, guilds, [self.spool_path])
+
+class ShardedWriter(object):
+    def __init__(self, directory, open_files=64):
+        """
+        Initializes the ShardedWriter, which writes one database file per guild into a directory.
+        Members are spooled per guild and every guild's file is assembled at the end.
+        :param directory: The directory to write to.
+        :param open_files: The maximum number of spool files kept open at once.
+        """
+        self.directory = directory
+        self.open_files = open_files
+        self.guilds = OrderedDict()
+        self.spools = OrderedDict()
+        os.makedirs(directory)
+
+    def spool_path(self, guild_id):
+        """
+        Returns the path of a guild's member spool file.
+        :param guild_id: The ID of the guild.
+        :return: The path of the spool file.
+        """
+        return os.path.join(self.directory, str(guild_id) + ".members.tmp")
+
+    def write(self, event):
+        """
+        Adds a guild or member to the output.
+        :param event: A guild or member tuple as produced by the readers.
+        """
+        if event[0] == "guild":
+            self.guilds[event[1]] = event[2]
+            return
+        guild_id = event[1]
+        self.guilds.setdefault(guild_id, None)
+        spool = self.spools.pop(guild_id, None)
+        if spool is None:
+            spool = open(self.spool_path(guild_id), "a", encoding="utf-8")
+            if len(self.spools) >= self.open_files:
+                self.spools.popitem(last=False)[1].close()
+        self.spools[guild_id] = spool
+        spool.write(json.dumps(member_document(*event[1:])) + "\n")
+
+    def close(self):
+        """
+        Assembles the file of every guild from its values and spooled members.
+        """
+        for spool in self.spools.values():
+            spool.close()
+        for guild_id, values in self.guilds.items():
+            path = os.path.join(self.directory, str(guild_id) + ".json")
+            assemble(path, [(guild_id, values or guild_defaults())], [self.spool_path(guild_id)])
+
+class SqliteWriter(object):
+    def __init__(self, path, batch_size=10000):
+        """
+        Initializes the SqliteWriter, which writes the SqliteDatabase schema.
+        :param path: The path of the database file.
+        :param batch_size: The number of rows inserted per statement batch.
+        """
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.executescript(SCHEMA)
+        self.batch_size = batch_size
+        self.guilds = []
+        self.members = []
+
+    def write(self, event):
+        """
+        Adds a guild or member to the output.
+        :param event: A guild or member tuple as produced by the readers.
+        """
+        if event[0] == "guild":
+            values = dict(guild_defaults(), **event[2])
+            values["roles"] = json.dumps(values["roles"])
+            self.guilds.append([event[1]] + [values[key] for key in GUILD_COLUMNS])
+        else:
+            document = member_document(*event[1:])
+            self.members.append([event[1], event[2]] + [document[key] for key in MEMBER_COLUMNS])
+        if len(self.guilds) + len(self.members) >= self.batch_size:
+            self.insert()
+
+    def insert(self):
+        """
+        Inserts the collected rows and commits them.
+        """
+        self.connection.executemany("INSERT OR REPLACE INTO guilds (guild_id, " + ", ".join(GUILD_COLUMNS) + ") VALUES (?" + ", ?" * len(GUILD_COLUMNS) + ")", self.guilds)
+        self.connection.executemany("INSERT OR REPLACE INTO members (guild_id, member_id, " + ", ".join(MEMBER_COLUMNS) + ") VALUES (?, ?" + ", ?" * len(MEMBER_COLUMNS) + ")", self.members)
+        self.connection.commit()
+        self.guilds = []
+        self.members = []
+
+    def close(self):
+        """
+        Inserts the remaining rows and closes the database.
+        Guilds that only appeared through their members get default values.
+        """
+        self.insert()
+        self.connection.execute("INSERT OR IGNORE INTO guilds (guild_id) SELECT DISTINCT guild_id FROM members")
+        self.connection.commit()
+        self.connection.close()
+
+class NdjsonWriter(object):
+    def __init__(self, path):
+        """
+        Initializes the NdjsonWriter, which writes one guild or member per line.
+        :param path: The path of the file to write.
+        """
+        self.handle = open(path, "w", encoding="utf-8")
+
+    def write(self, event):
+        """
+        Adds a guild or member to the output.
+        :param event: A guild or member tuple as produced by the readers.
+        """
+        if event[0] == "guild":
+            line = {"type": "guild", "guild_id": event[1]}
+            line.update(event[2])
+        else:
+            line = {"type": "member"}
+            line.update(member_document(*event[1:]))
+        self.handle.write(json.dumps(line) + "\n")
+
+    def close(self):
+        """
+        Closes the file.
+        """
+        self.handle.close()
+
+READERS = {"json": read_json, "sharded": read_sharded, "sqlite": read_sqlite, "ndjson": read_ndjson}
+WRITERS = {"json": JsonWriter, "sharded": ShardedWriter, "sqlite": SqliteWriter, "ndjson": NdjsonWriter}
+
+def guess_format(path):
+    """
+    Guesses the format of a database from its path.
+    :param path: The path of the database.
+    :return: The name of the format.
+    """
+    if os.path.isdir(path):
+        return "sharded"
+    if path.endswith(".z"):
+        return guess_format(path[:-2])
+    extension = os.path.splitext(path)[1]
+    return {".json": "json", ".sqlite3": "sqlite", ".sqlite": "sqlite", ".db": "sqlite", ".ndjson": "ndjson"}.get(extension, "sharded")
+
+def totals(events):
+    """
+    Counts the members and sums the XP of every guild.
+    :param events: Guild and member tuples as produced by the readers.
+    :return: A dict mapping guild IDs to [member count, XP total].
+    """
+    result = {}
+    for event in events:
+        if event[0] == "member":
+            total = result.setdefault(event[1], [0, 0.0])
+            total[0] += 1
+            total[1] += event[3].get("xp", 0)
+    return result
+
+def verify(source, target):
+    """
+    Compares the member count and XP total of every guild in source and target.
+    :param source: The source's guild and member tuples.
+    :param target: The target's guild and member tuples.
+    :return: A list of messages describing the differences, empty if both match.
+    """
+    expected = totals(source)
+    actual = totals(target)
+    problems = []
+    for guild_id in sorted(set(expected) | set(actual)):
+        count, xp = expected.get(guild_id, [0, 0.0])
+        target_count, target_xp = actual.get(guild_id, [0, 0.0])
+        if count != target_count or not math.isclose(xp, target_xp, rel_tol=1e-9, abs_tol=1e-6):
+            problems.append(f"guild {guild_id}: {count} members with {xp} xp in the source, {target_count} members with {target_xp} xp in the target")
+    return problems
+
+def main():
+    """
+    Parses the command line, converts the database and verifies the result.
+    """
+    parser = argparse.ArgumentParser(description="Convert the bot's data between storage formats.")
+    parser.add_argument("source", help="the database to read")
+    parser.add_argument("target", help="the database to write; must not exist yet")
+    parser.add_argument("--from", dest="source_format", choices=list(READERS), help="format of the source (guessed from the path by default)")
+    parser.add_argument("--to", dest="target_format", choices=list(WRITERS), help="format of the target (guessed from the path by default)")
+    parser.add_argument("--no-verify", action="store_true", help="skip comparing the xp totals afterwards")
+    arguments = parser.parse_args()
+
+    source_format = arguments.source_format or guess_format(arguments.source)
+    target_format = arguments.target_format or guess_format(arguments.target)
+    if os.path.exists(arguments.target):
+        sys.exit(f"{arguments.target} already exists")
+    if arguments.target.endswith(".z"):
+        sys.exit("compressed targets are not supported; write a .json target and open it with compression")
+    name = os.path.splitext(arguments.source[:-2] if arguments.source.endswith(".z") else arguments.source)[0]
+    journal_path = name + ".xplog"
+    if os.path.exists(journal_path) and os.path.getsize(journal_path) > HEADER.size:
+        sys.exit("the xp journal of the source has not been compacted yet; stop the bot first")
+
+    writer = WRITERS[target_format](arguments.target)
+    guilds = members = 0
+    for event in READERS[source_format](arguments.source):
+        writer.write(event)
+        if event[0] == "guild":
+            guilds += 1
+        else:
+            members += 1
+    writer.close()
+    print(f"converted {guilds} guilds and {members} members from {source_format} to {target_format}")
+
+    if not arguments.no_verify:
+        problems = verify(READERS[source_format](arguments.source), READERS[target_format](arguments.target))
+        for problem in problems:
+            print(problem)
+        if problems:
+            sys.exit("verification failed")
+        print("verified the member counts and xp totals of every guild")
+
+if __name__ == "__main__":
+    main()
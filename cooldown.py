@@ -0,0 +1,45 @@
+from collections import OrderedDict
+
+class Cooldown(object):
+    def __init__(self, period):
+        """
+        Initializes the Cooldown, an expiring dict of the times keys were last let through.
+        Keys are kept in the order of those times, so expired ones are pruned from the front
+        and memory only grows with the keys that were active during the last period.
+        :param period: The seconds a key has to wait between two passes.
+        """
+        self.period = period
+        self.entries = OrderedDict()
+
+    def prune(self, now):
+        """
+        Removes the keys whose cooldown has expired.
+        :param now: The current time.
+        """
+        while self.entries:
+            key, last = next(iter(self.entries.items()))
+            if now - last < self.period:
+                break
+            del self.entries[key]
+
+    def try_pass(self, key, now):
+        """
+        Lets a key through if its cooldown has expired and starts a new one.
+        :param key: The key, e.g. a (guild ID, member ID) pair.
+        :param now: The current time.
+        :return: True if the key was let through.
+        """
+        self.prune(now)
+        last = self.entries.get(key)
+        if last is not None and now - last < self.period:
+            return False
+        self.entries[key] = now
+        self.entries.move_to_end(key)
+        return True
+
+    def __len__(self):
+        """
+        Returns the number of keys on cooldown (including expired ones not pruned yet).
+        :return: The number of keys.
+        """
+        return len(self.entries)
@@ -1,41 +1,848 @@
-from tinydb import TinyDB, Query
+import asyncio
+import contextvars
+import json
+import os
+import sys
+from collections import OrderedDict
+from concurrent.futures import wait
+from contextlib import contextmanager
+from functools import wraps
+from time import monotonic
+from journal import XpJournal
+from locking import ProcessLock
+from metrics import counted
+from migrations import SCHEMA_VERSION, upgrade_guild
+from storage import JSONFileStorage, StorageWriter, compress_file
+from xp_table import XpTable
+
+MEMBER_DEFAULTS = {"xp": 0, "last_counted_message_time": 0, "last_voice_checkpoint": None}
+# Member values whose changes do not cause a write of their own. Voice checkpoints change on every voice tick,
+# so their guilds are only marked unsaved: they are written along with the next other change of their file,
+# when they are unloaded and when the database is closed.
+UNSAVED_MEMBER_KEYS = {"last_voice_checkpoint"}
+
+class MemberRecord(object):
+    """
+    The in-memory form of a member's stored values. Guild and member ID are the keys of the index
+    holding the record, so only the values and the record's document ID are kept, in slots instead of a dict.
+    Records are converted to and from JSON dicts only when a file is read or written.
+    """
+    __slots__ = ["doc_id", "xp", "last_counted_message_time", "last_voice_checkpoint"]
+
+    def __init__(self, doc_id, xp, last_counted_message_time, last_voice_checkpoint):
+        """
+        Initializes the MemberRecord.
+        :param doc_id: The document ID of the record in the "members" table.
+        :param xp: The member's XP.
+        :param last_counted_message_time: The time of the member's last message that gave XP.
+        :param last_voice_checkpoint: The time since which the member's voice XP is not counted yet, or None.
+        """
+        self.doc_id = doc_id
+        self.xp = xp
+        self.last_counted_message_time = last_counted_message_time
+        self.last_voice_checkpoint = last_voice_checkpoint
+
+    @classmethod
+    def from_dict(cls, doc_id, values):
+        """
+        Creates a record from stored member values, using the defaults for missing ones.
+        :param doc_id: The document ID of the record.
+        :param values: A dict of member values.
+        :return: The new record.
+        """
+        values = dict(MEMBER_DEFAULTS, **values)
+        return cls(doc_id, values["xp"], values["last_counted_message_time"], values["last_voice_checkpoint"])
+
+    def to_dict(self):
+        """
+        Returns the member values as stored in JSON.
+        :return: A dict of member values.
+        """
+        return {"xp": self.xp, "last_counted_message_time": self.last_counted_message_time, "last_voice_checkpoint": self.last_voice_checkpoint}
+
+    def __getitem__(self, key):
+        """
+        Allows reading a value like from the former dict records, e.g. record["xp"].
+        :param key: The name of the value.
+        :return: The value.
+        """
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        """
+        Allows changing a value like in the former dict records, e.g. record["xp"] = 5.
+        :param key: The name of the value.
+        :param value: The new value.
+        """
+        setattr(self, key, value)
+
+def record_size(record):
+    """
+    Estimates the memory used by a guild entry or member record and its values.
+    :param record: The guild entry or MemberRecord.
+    :return: The estimated size in bytes.
+    """
+    values = record.values() if isinstance(record, dict) else [getattr(record, slot) for slot in MemberRecord.__slots__]
+    return sys.getsizeof(record) + sum(sys.getsizeof(value) for value in values)
+
+def guild_defaults():
+    """
+    Returns the values of a new guild entry, stamped with the current schema version.
+    :return: A fresh dict with the default guild values.
+    """
+    return {"prefix": "!", "roles": {}, "rickroll_members": "", "rickroll_roles": "", "schema_version": SCHEMA_VERSION}
+
+class Shard(object):
+    def __init__(self, path, mapped_directory=None):
+        """
+        Loads one database file into memory. A file keeps guild entries in the "_default" table
+        and member records in the "members" table, the same layout TinyDB uses.
+        :param path: The path of the file.
+        :param mapped_directory: The directory of the guilds' memory-mapped XpTables <guild_id>.xp,
+                                 or None to keep member records in the "members" table.
+        """
+        self.path = path
+        self.mapped_directory = mapped_directory
+        self.storage = JSONFileStorage(path)
+        data = self.storage.read() or {}
+        self.table = data.get("_default", {})
+        self.guild_doc_ids = {guild["guild_id"]: doc_id for doc_id, guild in self.table.items()}
+        self.next_guild_doc_id = max([int(doc_id) for doc_id in self.table.keys()], default=0) + 1
+        self.members = {}
+        self.next_member_doc_id = 1
+        self.encoded = set()
+        self.fragments = {}
+        self.unmapped = {}
+        if mapped_directory is not None:
+            self.unmapped = data.get("members", {})
+        else:
+            for doc_id, member in data.get("members", {}).items():
+                self.add_record(member["guild_id"], member["member_id"], MemberRecord.from_dict(int(doc_id), member))
+
+    def estimated_size(self):
+        """
+        Estimates the memory used by the loaded file, assuming all records are about the size of the first one.
+        :return: The estimated size in bytes.
+        """
+        size = sys.getsizeof(self.table) + sys.getsizeof(self.members)
+        if self.table:
+            size += len(self.table) * record_size(next(iter(self.table.values())))
+        for records in self.members.values():
+            if isinstance(records, XpTable):
+                size += records.estimated_size()
+            elif records:
+                size += sys.getsizeof(records) + len(records) * record_size(next(iter(records.values())))
+        return size
+
+    def get_guild(self, guild_id):
+        """
+        Retrieves a guild entry of this file.
+        :param guild_id: The ID of the guild.
+        :return: The guild data, or None if the guild is not stored in this file.
+        """
+        doc_id = self.guild_doc_ids.get(guild_id)
+        return None if doc_id is None else self.table[doc_id]
+
+    def insert_guild(self, guild_id, values):
+        """
+        Adds a guild entry to the guild table and the guild index.
+        :param guild_id: The ID of the guild.
+        :param values: The stored values of the guild.
+        :return: The new guild entry.
+        """
+        guild = {"guild_id": guild_id}
+        guild.update(values)
+        doc_id = str(self.next_guild_doc_id)
+        self.next_guild_doc_id += 1
+        self.guild_doc_ids[guild_id] = doc_id
+        self.table[doc_id] = guild
+        return guild
+
+    def insert_member(self, guild_id, member_id, values):
+        """
+        Adds a member record to the member table and its guild's index.
+        :param guild_id: The ID of the member's guild.
+        :param member_id: The ID of the member.
+        :param values: The stored values of the member.
+        :return: The new member record.
+        """
+        records = self.member_records(guild_id)
+        if isinstance(records, XpTable):
+            return records.insert(member_id, values)
+        return self.add_record(guild_id, member_id, MemberRecord.from_dict(self.next_member_doc_id, values))
+
+    def member_records(self, guild_id):
+        """
+        Retrieves the member records of a guild, opening its XpTable on first use when mapped.
+        :param guild_id: The ID of the guild.
+        :return: A mapping of member IDs to records.
+        """
+        records = self.members.get(guild_id)
+        if records is None:
+            records = {} if self.mapped_directory is None else XpTable(os.path.join(self.mapped_directory, str(guild_id) + ".xp"))
+            self.members[guild_id] = records
+        return records
+
+    def add_record(self, guild_id, member_id, record):
+        """
+        Adds a MemberRecord to its guild's index.
+        :param guild_id: The ID of the member's guild.
+        :param member_id: The ID of the member.
+        :param record: The MemberRecord.
+        :return: The record.
+        """
+        self.member_records(guild_id)[member_id] = record
+        self.next_member_doc_id = max(self.next_member_doc_id, record.doc_id + 1)
+        return record
+
+    def migrate_members(self):
+        """
+        Moves members out of the nested "members" dict of old guild entries into their own records.
+        Runs once for files written before members had their own table, and when mapped,
+        once for the records of the "members" table, which are moved into the XpTables.
+        :return: The IDs of the migrated guilds.
+        """
+        migrated = set()
+        for guild in self.table.values():
+            if "members" in guild:
+                for member_id, member in guild.pop("members").items():
+                    self.insert_member(guild["guild_id"], int(member_id), member)
+                migrated.add(guild["guild_id"])
+        for member in self.unmapped.values():
+            # A table written before a crash may already contain the member
+            if member["member_id"] not in self.member_records(member["guild_id"]):
+                self.insert_member(member["guild_id"], member["member_id"], member)
+            migrated.add(member["guild_id"])
+        self.unmapped = {}
+        return list(migrated)
+
+    def guild_ids(self):
+        """
+        Lists the guilds stored in this file, in the order they are written.
+        :return: A list of guild IDs.
+        """
+        return list(self.guild_doc_ids) + [guild_id for guild_id in self.members if guild_id not in self.guild_doc_ids]
+
+    def snapshot(self, changed=None):
+        """
+        Copies the stored values so they can be serialized on the writer thread while the event loop keeps changing them.
+        Only guilds that changed or were never encoded are copied; the others are written from the fragments
+        encoded last time. Nested values such as "roles" are always replaced instead of changed in place,
+        so copying each guild entry is enough. Member records are copied as plain tuples,
+        except for mapped ones, which are already in their files and only need to be flushed.
+        :param changed: The IDs of the guilds changed since the last snapshot, or None to copy every guild.
+        :return: A tuple of the guild order, a dict mapping the copied guilds to their values and a list of XpTables.
+        """
+        order = self.guild_ids()
+        guilds = {}
+        for guild_id in order:
+            if changed is None or guild_id in changed or guild_id not in self.encoded:
+                self.encoded.add(guild_id)
+                doc_id = self.guild_doc_ids.get(guild_id)
+                guild = None if doc_id is None else dict(self.table[doc_id])
+                records = self.members.get(guild_id, {})
+                members = [] if isinstance(records, XpTable) else [
+                    (record.doc_id, member_id, record.xp, record.last_counted_message_time, record.last_voice_checkpoint)
+                    for member_id, record in records.items()
+                ]
+                guilds[guild_id] = (doc_id, guild, members)
+        tables = [records for records in self.members.values() if isinstance(records, XpTable)]
+        return order, guilds, tables
+
+    def encode(self, guild_id, doc_id, guild, members):
+        """
+        Encodes a guild entry and its member records as fragments of the guild and member tables.
+        :param guild_id: The ID of the guild.
+        :param doc_id: The document ID of the guild entry, or None if the guild has no entry.
+        :param guild: The guild entry, or None.
+        :param members: The guild's member tuples from snapshot.
+        :return: A tuple of the guild table fragment and the member table fragment; either may be empty.
+        """
+        guild_fragment = "" if guild is None else json.dumps(doc_id) + ": " + json.dumps(guild)
+        member_fragment = ", ".join(
+            json.dumps(str(member_doc_id)) + ": " + json.dumps({"guild_id": guild_id, "member_id": member_id, "xp": xp, "last_counted_message_time": last_counted_message_time, "last_voice_checkpoint": last_voice_checkpoint})
+            for member_doc_id, member_id, xp, last_counted_message_time, last_voice_checkpoint in members
+        )
+        return guild_fragment, member_fragment
+
+    def write(self, snapshot):
+        """
+        Encodes the changed guilds of a snapshot and writes the file in TinyDB's layout by splicing
+        the fragments of all guilds together, after flushing the XpTables. Runs on the writer thread,
+        which alone owns the fragments.
+        :param snapshot: The result of snapshot.
+        """
+        order, guilds, tables = snapshot
+        for table in tables:
+            table.flush()
+        for guild_id, values in guilds.items():
+            self.fragments[guild_id] = self.encode(guild_id, *values)
+        fragments = [self.fragments[guild_id] for guild_id in order]
+        self.storage.write_chunks([
+            '{"_default": {', ", ".join(fragment[0] for fragment in fragments if fragment[0]),
+            '}, "members": {', ", ".join(fragment[1] for fragment in fragments if fragment[1]), "}}"
+        ])
+
+    def write_and_close(self, snapshot):
+        """
+        Writes a snapshot like write and closes the XpTables afterwards. If the write fails, they stay open,
+        so the Shard can be loaded again.
+        :param snapshot: The result of snapshot.
+        """
+        self.write(snapshot)
+        self.close()
+
+    def close(self):
+        """
+        Closes the XpTables of the file.
+        """
+        for records in self.members.values():
+            if isinstance(records, XpTable):
+                records.close()
+
+def split_into_shards(name, extension=".json", mapped=False):
+    """
+    Migrates a single-file database into one file per guild inside the directory of the same name.
+    The old file is kept as <name><extension>.migrated.
+    :param name: The name of the database file (without extension).
+    :param extension: The extension of the database files, ".json" or ".json.z".
+    :param mapped: Whether the members are moved into XpTables next to the guild files.
+    """
+    source = Shard(name + extension)
+    source.migrate_members()
+    os.makedirs(name, exist_ok=True)
+    for guild_id in set(source.guild_doc_ids) | set(source.members):
+        shard = Shard(os.path.join(name, str(guild_id) + extension), name if mapped else None)
+        shard.insert_guild(guild_id, source.get_guild(guild_id) or guild_defaults())
+        for member_id, record in source.members.get(guild_id, {}).items():
+            shard.insert_member(guild_id, member_id, record.to_dict())
+        shard.write(shard.snapshot())
+        shard.close()
+    os.replace(name + extension, name + extension + ".migrated")
+
+def locked(method):
+    """
+    Makes a Database method run under the process lock when the database is shared.
+    :param method: The method.
+    :return: The wrapped method.
+    """
+    @wraps(method)
+    def wrapper(self, *args):
+        if self.lock is None:
+            return method(self, *args)
+        with self.exclusive():
+            return method(self, *args)
+    return wrapper
 
 class Database(object):
-    def __init__(self, name):
+    def __init__(self, name, flush_interval=None, journal=False, compact_interval=300, sharded=False, max_guilds=None, max_bytes=None, commit_delay=None, compress=False, mapped=False, shared=False, lock_timeout=1.0):
         """
-        Initializes the Database object with a TinyDB instance.
+        Initializes the Database object and loads the stored documents into memory.
         :param name: The name of the database file (without extension).
+        :param flush_interval: Seconds between writes of changed guilds to disk.
+                               None writes every change to disk immediately.
+        :param journal: Whether xp gains are appended to an xp journal instead of rewriting the snapshot.
+        :param compact_interval: Seconds between folds of the xp journal into the snapshot.
+        :param sharded: Whether every guild is stored in its own file <name>/<guild_id>.json,
+                        loaded when the guild is first used. An existing <name>.json is split up once.
+        :param max_guilds: The maximum number of guilds kept in memory when sharded.
+        :param max_bytes: The maximum estimated memory of the guilds kept in memory when sharded.
+                          Above either limit the least recently used guilds are written back and unloaded.
+        :param commit_delay: Seconds that changes are collected before being written in one group commit,
+                             when there is no flush interval. None writes every change on its own.
+        :param compress: Whether the files are stored zlib-compressed as <name>.json.z (or <name>/<guild_id>.json.z).
+                         Existing uncompressed files are compressed once and kept as *.json.migrated.
+        :param mapped: Whether the member records of each guild are kept in a memory-mapped XpTable
+                       <name>.xp/<guild_id>.xp (or <name>/<guild_id>.xp when sharded) instead of the JSON files.
+                       Existing members are moved into the tables once.
+        :param shared: Whether several processes use the database at the same time. Every call and transaction
+                       then runs under an advisory file lock <name>.lock, reloads the files if another process
+                       committed changes since, and writes its own changes before releasing the lock.
+        :param lock_timeout: The maximum seconds a shared database waits for the lock before raising TimeoutError,
+                             so another process holding it cannot stall the event loop for long. None waits forever.
         """
+        if journal and flush_interval is None:
+            raise ValueError("the xp journal is compacted by autoflush and needs a flush interval")
+        if (max_guilds is not None or max_bytes is not None) and not sharded:
+            raise ValueError("only a sharded database can unload guilds")
+        if commit_delay is not None and flush_interval is not None:
+            raise ValueError("a commit delay only applies to a database without a flush interval")
+        if journal and mapped:
+            raise ValueError("mapped member records are changed in place and cannot be journaled")
+        if shared and (flush_interval is not None or journal):
+            raise ValueError("a shared database writes every change under the lock and cannot delay writes")
         self.name = name
-        self.data = TinyDB(name + ".json")
+        self.flush_interval = flush_interval
+        self.commit_delay = commit_delay
+        self.scheduled_commit = None
+        self.compact_interval = compact_interval
+        self.last_compaction = monotonic()
+        self.sharded = sharded
+        self.max_guilds = max_guilds
+        self.max_bytes = max_bytes
+        self.writer = StorageWriter()
+        self.shards = OrderedDict()
+        self.pending = {}
+        # path -> number of snapshot writes queued for the file, so a read can tell whether it is already outdated
+        self.generations = {}
+        # (future, guild IDs, Shard if it was unloaded) of the snapshot writes that may not have finished yet
+        self.writes = []
+        self.pinned = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.dirty = set()
+        # Guilds with changes of UNSAVED_MEMBER_KEYS that have not been written yet
+        self.unsaved = set()
+        # Unloaded guilds whose voice checkpoints are reset once they are loaded
+        self.checkpoint_resets = set()
+        self.transactions = 0
+        self.compress = compress
+        self.extension = ".json.z" if compress else ".json"
+        self.mapped_directory = None
+        if mapped:
+            self.mapped_directory = name if sharded else name + ".xp"
+            os.makedirs(self.mapped_directory, exist_ok=True)
+        self.main_shard = None
+        self.lock = None
+        self.lock_timeout = lock_timeout
+        self.lock_depth = 0
+        self.version = None
+        if shared:
+            self.lock = ProcessLock(name + ".lock")
+            # Taking the lock for the first time finds an unseen version and opens the files
+            with self.exclusive():
+                pass
+        else:
+            self.open()
+        self.journal = None
+        self.journaled = set()
+        if journal:
+            self.journal = XpJournal(name + ".xplog", self.writer)
+            self.replay_journal()
+
+    def open(self):
+        """
+        Converts the files once where the options require it (compression, one file per guild)
+        and loads the database file. When sharded, guild files are only loaded on first use.
+        """
+        if self.compress and os.path.exists(self.name + ".json") and not os.path.exists(self.name + ".json.z"):
+            compress_file(self.name + ".json")
+        if self.sharded:
+            if os.path.exists(self.name + self.extension):
+                split_into_shards(self.name, self.extension, self.mapped_directory is not None)
+            os.makedirs(self.name, exist_ok=True)
+            if self.compress:
+                for file_name in os.listdir(self.name):
+                    if file_name.endswith(".json") and not os.path.exists(os.path.join(self.name, file_name + ".z")):
+                        compress_file(os.path.join(self.name, file_name))
+        else:
+            self.main_shard = self.open_shard(self.name + self.extension)
 
+    def reload(self):
+        """
+        Drops everything loaded and opens the files again, e.g. after another process changed them.
+        """
+        for shard in set(self.shards.values()):
+            shard.close()
+        self.shards.clear()
+        self.pending.clear()
+        self.main_shard = None
+        self.open()
+
+    @contextmanager
+    def exclusive(self):
+        """
+        Holds the process lock of a shared database, waiting at most lock_timeout seconds for it.
+        If another process committed changes since this one last held the lock, the files are reloaded first. When the outermost exclusive section ends,
+        the changes are written and the version is increased before the lock is released.
+        Without sharing this does nothing.
+        """
+        if self.lock is None:
+            yield
+            return
+        if not self.lock_depth:
+            version = self.lock.acquire(self.lock_timeout)
+            if version != self.version:
+                try:
+                    self.reload()
+                except BaseException:
+                    # Released with the version read, so the failed reload is tried again next time
+                    self.lock.release(version)
+                    raise
+                self.version = version
+        self.lock_depth += 1
+        try:
+            yield
+        finally:
+            self.lock_depth -= 1
+            if not self.lock_depth:
+                try:
+                    if self.dirty:
+                        self.flush()
+                        self.writer.wait()
+                        self.version += 1
+                finally:
+                    self.lock.release(self.version)
+
+    def lock_stats(self):
+        """
+        Returns the counters of the process lock.
+        :return: A dict with the number of acquisitions and timeouts and the total, average and maximum wait in seconds,
+                 or None if the database is not shared.
+        """
+        return None if self.lock is None else self.lock.stats()
+
+    def shard_path(self, guild_id):
+        """
+        Returns the path of the file a guild is stored in when the database is sharded.
+        :param guild_id: The ID of the guild.
+        :return: The path of the guild's file.
+        """
+        return os.path.join(self.name, str(guild_id) + self.extension)
+
+    def open_shard(self, path):
+        """
+        Loads a database file and registers the guilds it contains.
+        :param path: The path of the file.
+        :return: The loaded Shard.
+        """
+        return self.register_shard(Shard(path, self.mapped_directory))
+
+    def register_shard(self, shard):
+        """
+        Registers the guilds of a loaded Shard and moves its members where the options require it.
+        :param shard: The Shard.
+        :return: The Shard.
+        """
+        for guild_id in shard.guild_doc_ids:
+            self.shards[guild_id] = shard
+        for guild_id in shard.migrate_members():
+            self.mark_dirty(guild_id)
+        for guild_id in self.checkpoint_resets.intersection(shard.guild_doc_ids):
+            self.checkpoint_resets.discard(guild_id)
+            self.clear_voice_checkpoints(guild_id, shard.member_records(guild_id))
+        return shard
+
+    def load_shard(self, guild_id):
+        """
+        Retrieves the Shard that stores a guild, loading the guild's file on first use when sharded.
+        :param guild_id: The ID of the guild.
+        :return: The Shard, or None if the guild is not stored yet.
+        """
+        shard = self.shards.get(guild_id)
+        if not self.sharded:
+            return shard
+        if shard is not None:
+            self.hits += 1
+            self.shards.move_to_end(guild_id)
+            return shard
+        self.misses += 1
+        path = self.shard_path(guild_id)
+        if path in self.pending:
+            wait([self.pending.pop(path)])
+            # A failed write of the guild's file brings the guild back instead
+            self.retry_failed_writes()
+            if guild_id in self.shards:
+                return self.shards[guild_id]
+        if os.path.exists(path):
+            shard = self.open_shard(path)
+            self.evict()
+        return shard
+
+    def read_shard(self, path):
+        """
+        Reads a guild's file without registering it. Runs on a worker thread.
+        :param path: The path of the file.
+        :return: The Shard, or None if the file does not exist.
+        """
+        return Shard(path, self.mapped_directory) if os.path.exists(path) else None
+
+    async def preload(self, guild_id):
+        """
+        Loads a guild's file on a worker thread when sharded, so an event's first access to
+        an unloaded guild does not read and parse the file on the event loop.
+        Waiting for a queued write of the file happens without blocking the loop as well.
+        Does nothing when the guild is loaded already, and when shared, as files may only be read under the lock.
+        :param guild_id: The ID of the guild.
+        """
+        if not self.sharded or self.lock is not None or guild_id in self.shards:
+            return
+        path = self.shard_path(guild_id)
+        loop = asyncio.get_running_loop()
+        while True:
+            generation = self.generations.get(path, 0)
+            if path in self.pending:
+                await asyncio.wrap_future(self.pending[path])
+                self.retry_failed_writes()
+                if guild_id in self.shards:
+                    return
+            shard = await loop.run_in_executor(None, contextvars.copy_context().run, self.read_shard, path)
+            if guild_id in self.shards:
+                # Loaded by another event in the meantime
+                if shard is not None:
+                    shard.close()
+                return
+            if self.generations.get(path, 0) == generation:
+                break
+            # The guild was loaded, changed and unloaded again during the read, so the file read may be outdated
+            if shard is not None:
+                shard.close()
+        if shard is not None:
+            self.misses += 1
+            self.register_shard(shard)
+            self.evict()
+
+    def evict(self):
+        """
+        Writes back and unloads the least recently used guilds until the loaded guilds fit the limits.
+        Guilds with an open transaction and the most recently used guild are never unloaded.
+        """
+        size = sum(shard.estimated_size() for shard in self.shards.values()) if self.max_bytes is not None else 0
+        for guild_id in list(self.shards)[:-1]:
+            if (self.max_guilds is None or len(self.shards) <= self.max_guilds) and (self.max_bytes is None or size <= self.max_bytes):
+                break
+            if guild_id not in self.pinned:
+                size -= self.shards[guild_id].estimated_size()
+                self.unload(guild_id)
+
+    def unload(self, guild_id):
+        """
+        Removes a guild from memory, queueing a write first if it has unsaved changes.
+        The Shard is kept with the write until it has succeeded, so a failed write can be retried.
+        :param guild_id: The ID of the guild.
+        """
+        shard = self.shards.pop(guild_id)
+        if guild_id in self.dirty or guild_id in self.journaled or guild_id in self.unsaved:
+            future = self.queue_write(shard, shard.snapshot(), close=True)
+            self.writes.append((future, [guild_id], shard))
+            self.dirty.discard(guild_id)
+            self.journaled.discard(guild_id)
+            self.unsaved.discard(guild_id)
+        elif self.mapped_directory is not None:
+            self.pending[shard.path] = self.writer.submit(shard.close)
+        self.evictions += 1
+
+    def cache_stats(self):
+        """
+        Returns the counters of the guild cache.
+        :return: A dict with the number of hits, misses, evictions and loaded guilds, or None if the database is not sharded.
+        """
+        if not self.sharded:
+            return None
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "loaded": len(self.shards)}
+
+    def replay_journal(self):
+        """
+        Applies the xp journal records that are not yet part of the snapshot.
+        Each guild remembers the sequence number of the last record its snapshot contains.
+        """
+        for seq, guild_id, member_id, delta in self.journal.replay():
+            guild = self.get_guild(guild_id)
+            if seq > guild.get("journal_seq", 0):
+                record = self.get_members(guild_id).get(member_id)
+                if record is None:
+                    record = self.insert_member(guild_id, member_id, MEMBER_DEFAULTS)
+                record["xp"] += delta
+                guild["journal_seq"] = seq
+                self.journaled.add(guild_id)
+
+    def mark_dirty(self, guild_id):
+        """
+        Marks a guild as changed. Without a flush interval the change is committed right away,
+        unless a transaction is open, which commits it when it ends.
+        :param guild_id: The ID of the changed guild.
+        """
+        self.dirty.add(guild_id)
+        self.commit()
+
+    def commit(self):
+        """
+        Writes finished changes when there is no flush interval. With a commit delay the write is scheduled
+        on the event loop instead, so all changes made until then are written together in one group commit.
+        """
+        if self.flush_interval is not None or self.transactions or self.lock_depth:
+            return
+        if self.commit_delay is None:
+            self.flush()
+        elif self.scheduled_commit is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self.flush()
+                return
+            self.scheduled_commit = loop.call_later(self.commit_delay, self.group_commit)
+
+    def group_commit(self):
+        """
+        Writes all changes collected since the commit was scheduled.
+        """
+        self.scheduled_commit = None
+        self.flush()
+
+    @contextmanager
+    def transaction(self, guild_id):
+        """
+        Groups all reads and changes of one event into a single unit of work.
+        The guild is loaded once when the transaction starts and all changes are written together when it ends.
+        Transactions can be nested; only the outermost one writes.
+        :param guild_id: The ID of the guild the event belongs to.
+        """
+        with self.exclusive():
+            self.get_guild(guild_id)
+            self.transactions += 1
+            self.pinned[guild_id] = self.pinned.get(guild_id, 0) + 1
+            try:
+                yield
+            finally:
+                self.transactions -= 1
+                self.pinned[guild_id] -= 1
+                if not self.pinned[guild_id]:
+                    del self.pinned[guild_id]
+                self.commit()
+
+    @counted
+    def flush(self):
+        """
+        Queues a write of every file with a guild that has changed since the last flush.
+        Serializing and writing happen on the writer thread, so the event loop is not blocked.
+        Guilds whose earlier write failed are written again. Unsaved guilds are written along when their file is.
+        """
+        self.retry_failed_writes()
+        if self.dirty:
+            changed = self.dirty | self.unsaved
+            for shard in {self.shards[guild_id] for guild_id in self.dirty}:
+                guild_ids = [guild_id for guild_id in changed if self.shards[guild_id] is shard]
+                self.unsaved.difference_update(guild_ids)
+                future = self.queue_write(shard, shard.snapshot(changed))
+                self.writes.append((future, guild_ids, None))
+            self.dirty.clear()
+        self.pending = {path: future for path, future in self.pending.items() if not future.done()}
+
+    def queue_write(self, shard, snapshot, close=False):
+        """
+        Queues the write of a snapshot on the writer thread and remembers it for its file.
+        A guild unloaded before the write finished must not be read back until it has.
+        :param shard: The Shard.
+        :param snapshot: The result of shard.snapshot.
+        :param close: Whether the Shard's files are closed after the write succeeded, when it is unloaded.
+        :return: The future of the write.
+        """
+        future = self.writer.submit(shard.write_and_close if close else shard.write, snapshot)
+        self.pending[shard.path] = future
+        self.generations[shard.path] = self.generations.get(shard.path, 0) + 1
+        return future
+
+    def retry_failed_writes(self):
+        """
+        Marks the guilds of failed snapshot writes (e.g. on a full disk) as dirty again, so the next flush retries them.
+        Guilds whose write failed while they were unloaded are loaded again from the kept Shard, as their file is outdated.
+        Runs on the event loop, so the writer thread never touches the dirty set.
+        """
+        unfinished = []
+        for future, guild_ids, unloaded in self.writes:
+            if not future.done():
+                unfinished.append((future, guild_ids, unloaded))
+            elif future.exception() is not None:
+                if unloaded is not None:
+                    for guild_id in guild_ids:
+                        self.shards.setdefault(guild_id, unloaded)
+                self.dirty.update(guild_id for guild_id in guild_ids if guild_id in self.shards)
+        self.writes = unfinished
+
+    def close(self):
+        """
+        Writes all pending changes, waits for the writer thread to finish and closes the files.
+        With a journal, all journaled xp is folded into the snapshot first, so the files are complete on their own.
+        """
+        if self.scheduled_commit is not None:
+            self.scheduled_commit.cancel()
+            self.scheduled_commit = None
+        self.dirty.update(self.unsaved)
+        self.unsaved.clear()
+        if self.journal is not None:
+            self.compact()
+        else:
+            self.flush()
+        # Gives writes that failed one more try before the writer stops
+        self.writer.wait()
+        self.flush()
+        self.writer.close()
+        for shard in set(self.shards.values()):
+            shard.close()
+        if self.journal is not None:
+            self.journal.close()
+        if self.lock is not None:
+            self.lock.close()
+
+    @counted
+    def compact(self):
+        """
+        Folds the xp journal into the snapshot by writing every guild with journaled xp, then empties the journal.
+        """
+        self.dirty.update(self.journaled)
+        self.journaled.clear()
+        self.flush()
+        self.journal.truncate([future for future, guild_ids, unloaded in self.writes])
+        self.last_compaction = monotonic()
+
+    async def autoflush(self):
+        """
+        Flushes the changed guilds to disk every flush_interval seconds
+        and compacts the xp journal every compact_interval seconds.
+        Meant to run as a background task for the lifetime of the client.
+        """
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if self.journal is not None and monotonic() - self.last_compaction >= self.compact_interval:
+                self.compact()
+            else:
+                self.flush()
+
+    @counted
+    @locked
     def save_guild(self, guild_id):
         """
         Saves a new guild entry with default values.
         :param guild_id: The ID of the guild to save.
         """
-        self.data.insert({"guild_id": guild_id, "prefix": "!", "roles": {}, "rickroll_members": "", "rickroll_roles": "", "members": {}})
+        shard = self.main_shard or Shard(self.shard_path(guild_id), self.mapped_directory)
+        shard.insert_guild(guild_id, guild_defaults())
+        self.shards[guild_id] = shard
+        self.mark_dirty(guild_id)
+        if self.sharded:
+            self.evict()
 
+    @counted
+    @locked
     def get_guild(self, guild_id):
         """
         Retrieves guild data by ID. If not found, creates a new entry.
+        Entries of an older schema version are migrated on first access and written with the next flush,
+        so a format change never requires rewriting the whole database at startup.
         :param guild_id: The ID of the guild to retrieve.
         :return: The guild data.
         """
-        data = self.data.search(Query().guild_id == guild_id)
-        if len(data) == 0:
+        if self.load_shard(guild_id) is None:
             self.save_guild(guild_id)
-            data = self.data.search(Query().guild_id == guild_id)
-        return data[0]
+        guild = self.shards[guild_id].get_guild(guild_id)
+        if upgrade_guild(guild):
+            self.mark_dirty(guild_id)
+        return guild
 
+    @counted
+    @locked
     def update_guild(self, guild_id, update):
         """
         Updates an existing guild entry with new data.
         :param guild_id: The ID of the guild to update.
         :param update: The data to update in the guild entry.
         """
-        self.data.update(update, Query().guild_id == guild_id)
+        self.get_guild(guild_id).update(update)
+        self.mark_dirty(guild_id)
 
+    @counted
+    @locked
     def change_in_guild(self, guild_id, key, value):
         """
         Changes a specific key-value pair in a guild entry.
@@ -43,10 +850,10 @@ class Database(object):
         :param key: The key to update.
         :param value: The new value for the key.
         """
-        guild = self.get_guild(guild_id)
-        guild.update({key: value})
-        self.update_guild(guild_id, guild)
+        self.update_guild(guild_id, {key: value})
 
+    @counted
+    @locked
     def get_from_guild(self, guild_id, key):
         """
         Retrieves a specific value from a guild by key.
@@ -57,15 +864,71 @@ class Database(object):
         guild = self.get_guild(guild_id)
         return guild[key]
 
+    @counted
+    @locked
+    def insert_member(self, guild_id, member_id, values):
+        """
+        Adds a member record to the file of its guild, creating the guild if needed.
+        :param guild_id: The ID of the member's guild.
+        :param member_id: The ID of the member.
+        :param values: The stored values of the member.
+        :return: The new member record.
+        """
+        self.get_guild(guild_id)
+        return self.shards[guild_id].insert_member(guild_id, member_id, values)
+
+    @counted
+    @locked
+    def get_members(self, guild_id):
+        """
+        Retrieves all member records of a guild.
+        :param guild_id: The ID of the guild.
+        :return: A dict mapping member IDs to their records.
+        """
+        shard = self.load_shard(guild_id)
+        return {} if shard is None else shard.member_records(guild_id)
+
+    @counted
+    @locked
+    def get_member_xp(self, guild_id):
+        """
+        Retrieves the XP of all members of a guild in one pass.
+        Mapped member records are read in one sequential scan of the table instead of record by record.
+        :param guild_id: The ID of the guild.
+        :return: A list of (member ID, xp) pairs.
+        """
+        records = self.get_members(guild_id)
+        if isinstance(records, XpTable):
+            return [(member_id, xp) for member_id, xp, last_counted_message_time, last_voice_checkpoint in records.scan()]
+        return [(member_id, record.xp) for member_id, record in records.items()]
+
+    @counted
+    @locked
     def save_member(self, member):
         """
         Saves a new member entry with default values.
         :param member: The member object to save.
+        :return: The new member record.
         """
-        members = self.get_from_guild(member.guild.id, "members")
-        members.update({str(member.id): {"xp": 0, "last_counted_message_time": 0, "last_voice_checkpoint": None}})
-        self.change_in_guild(member.guild.id, "members", members)
+        record = self.insert_member(member.guild.id, member.id, MEMBER_DEFAULTS)
+        self.mark_dirty(member.guild.id)
+        return record
 
+    @counted
+    @locked
+    def get_member(self, member):
+        """
+        Retrieves the record of a member. If not found, creates a new entry.
+        :param member: The member object to retrieve the record for.
+        :return: The member record.
+        """
+        record = self.get_members(member.guild.id).get(member.id)
+        if record is None:
+            record = self.save_member(member)
+        return record
+
+    @counted
+    @locked
     def get_from_member(self, member, key):
         """
         Retrieves a specific value from a member by key.
@@ -74,25 +937,74 @@ class Database(object):
         :param key: The key to retrieve the value for.
         :return: The value associated with the key for the member.
         """
-        members = self.get_from_guild(member.guild.id, "members")
-        if str(member.id) not in members.keys():
-            self.save_member(member)
-            members = self.get_from_guild(member.guild.id, "members")
-        member = members[str(member.id)]
-        return member[key]
+        return self.get_member(member)[key]
 
+    @counted
+    @locked
     def change_in_member(self, member, key, value):
         """
         Changes a specific key-value pair in a member entry.
         If the member does not exist, creates a new entry.
+        Only the member's own record is touched, independent of the size of its guild.
+        Changes of UNSAVED_MEMBER_KEYS only mark the guild unsaved, so with the xp journal
+        a voice tick only appends to the journal instead of rewriting the snapshot.
+        A shared database marks the guild dirty anyway, as another process's changes make it reload its files.
         :param member: The member object to update.
         :param key: The key to update.
         :param value: The new value for the key.
         """
-        members = self.get_from_guild(member.guild.id, "members")
-        if str(member.id) not in members.keys():
-            self.save_member(member)
-            members = self.get_from_guild(member.guild.id, "members")
-        member_obj = members[str(member.id)]
-        member_obj.update({key: value})
-        self.change_in_guild(member.guild.id, "members", members)
+        self.get_member(member)[key] = value
+        if key in UNSAVED_MEMBER_KEYS and self.lock is None:
+            self.unsaved.add(member.guild.id)
+        else:
+            self.mark_dirty(member.guild.id)
+
+    @counted
+    @locked
+    def add_to_member(self, member, key, amount):
+        """
+        Adds an amount to a numeric value of a member entry.
+        With the xp journal enabled, xp gains are appended to the journal instead of marking the guild dirty.
+        :param member: The member object to update.
+        :param key: The key of the value to increase.
+        :param amount: The amount to add.
+        """
+        record = self.get_member(member)
+        record[key] += amount
+        if self.journal is not None and key == "xp":
+            guild = self.get_guild(member.guild.id)
+            guild["journal_seq"] = self.journal.append(member.guild.id, member.id, amount)
+            self.journaled.add(member.guild.id)
+        else:
+            self.mark_dirty(member.guild.id)
+
+    @counted
+    @locked
+    def reset_voice_checkpoints(self, guild_id):
+        """
+        Clears the voice checkpoint of every member of a guild in one pass.
+        When sharded, a guild that is not loaded is only reset once it is loaded, so connecting does not read every file.
+        :param guild_id: The ID of the guild.
+        :return: The number of cleared checkpoints, 0 if the reset was deferred.
+        """
+        if self.sharded and guild_id not in self.shards:
+            self.checkpoint_resets.add(guild_id)
+            return 0
+        return self.clear_voice_checkpoints(guild_id, self.get_members(guild_id))
+
+    def clear_voice_checkpoints(self, guild_id, records):
+        """
+        Clears the voice checkpoints of a guild's member records.
+        The guild is written once, and only if a checkpoint was set, so no stale checkpoint can be read back later.
+        :param guild_id: The ID of the guild.
+        :param records: The member records of the guild.
+        :return: The number of cleared checkpoints.
+        """
+        cleared = 0
+        for record in records.values():
+            if record["last_voice_checkpoint"] is not None:
+                record["last_voice_checkpoint"] = None
+                cleared += 1
+        if cleared:
+            self.mark_dirty(guild_id)
+        return cleared
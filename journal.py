@@ -0,0 +1,98 @@
+import os
+import struct
+from time import perf_counter
+from metrics import STATS
+
+HEADER = struct.Struct("<Q")     # sequence number the journal continues from
+RECORD = struct.Struct("<QQQd")  # sequence number, guild ID, member ID, xp delta
+
+class XpJournal(object):
+    def __init__(self, path, writer):
+        """
+        Initializes the XpJournal, an append-only log of fixed-size xp delta records.
+        :param path: The path of the journal file.
+        :param writer: The StorageWriter that performs the file writes.
+        """
+        self.path = path
+        self.writer = writer
+        if not os.path.exists(path):
+            self.reset(0)
+        self.handle = open(path, "rb+")
+        self.seq = HEADER.unpack(self.handle.read(HEADER.size))[0]
+        self.handle.seek(0, os.SEEK_END)
+
+    def replay(self):
+        """
+        Reads all complete records of the journal. A record cut off by a crash is ignored.
+        :return: A list of (seq, guild_id, member_id, delta) tuples in the order they were written.
+        """
+        self.handle.seek(HEADER.size)
+        data = self.handle.read()
+        complete = len(data) - len(data) % RECORD.size
+        records = list(RECORD.iter_unpack(data[:complete]))
+        if records:
+            self.seq = max(self.seq, records[-1][0])
+        self.handle.seek(HEADER.size + complete)
+        self.handle.truncate()
+        return records
+
+    def append(self, guild_id, member_id, delta):
+        """
+        Appends an xp delta to the journal. The sequence number is assigned right away,
+        the write itself happens on the writer thread.
+        :param guild_id: The ID of the member's guild.
+        :param member_id: The ID of the member.
+        :param delta: The amount of xp gained.
+        :return: The sequence number of the record.
+        """
+        self.seq += 1
+        self.writer.submit(self.write, RECORD.pack(self.seq, guild_id, member_id, delta))
+        return self.seq
+
+    def write(self, record):
+        """
+        Writes a packed record to the end of the journal file.
+        :param record: The packed record.
+        """
+        start = perf_counter()
+        self.handle.write(record)
+        self.handle.flush()
+        STATS.record("write_journal", perf_counter() - start, written=len(record))
+
+    def truncate(self, writes=()):
+        """
+        Empties the journal once all of its records are part of the snapshot.
+        Queued on the writer thread behind the snapshot writes it depends on.
+        :param writes: The futures of those snapshot writes. If one of them failed, the journal is kept.
+        """
+        self.writer.submit(self.restart, self.seq, writes)
+
+    def restart(self, seq, writes=()):
+        """
+        Replaces the journal file with an empty one and reopens it.
+        :param seq: The last sequence number handed out before the truncation.
+        :param writes: The futures of the snapshot writes the truncation depends on, all finished by now.
+        """
+        if any(future.exception() is not None for future in writes):
+            return
+        self.handle.close()
+        self.reset(seq)
+        self.handle = open(self.path, "rb+")
+        self.handle.seek(0, os.SEEK_END)
+
+    def reset(self, seq):
+        """
+        Atomically replaces the journal file with an empty one continuing at the given sequence number.
+        :param seq: The last sequence number handed out.
+        """
+        with open(self.path + ".tmp", "wb") as handle:
+            handle.write(HEADER.pack(seq))
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(self.path + ".tmp", self.path)
+
+    def close(self):
+        """
+        Closes the journal file.
+        """
+        self.handle.close()
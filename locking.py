@@ -0,0 +1,91 @@
+import os
+import struct
+from time import perf_counter, sleep
+from metrics import STATS
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+VERSION = struct.Struct("<Q")  # number of changes committed to the database so far
+
+class ProcessLock(object):
+    def __init__(self, path):
+        """
+        Initializes the ProcessLock, an advisory lock shared by all processes using the same database.
+        The lock file also holds a version counter that is increased whenever a process commits changes,
+        so the others can tell whether their copy in memory is still current.
+        :param path: The path of the lock file, created if it does not exist.
+        """
+        if fcntl is None:
+            raise OSError("sharing a database between processes needs fcntl, which this platform does not have")
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.version = 0
+        self.acquisitions = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def acquire(self, timeout=None):
+        """
+        Waits until this process holds the lock and records how long that took, also in STATS as "lock_wait".
+        With a timeout the lock is polled instead of waited for, so a process holding it for long
+        (e.g. a maintenance script) cannot stall the caller for more than the timeout.
+        :param timeout: The maximum seconds to wait, or None to wait as long as it takes.
+        :return: The current version of the database.
+        """
+        start = perf_counter()
+        if timeout is None:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        else:
+            delay = 0.001
+            while True:
+                try:
+                    fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    remaining = timeout - (perf_counter() - start)
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        STATS.record("lock_wait", perf_counter() - start)
+                        raise TimeoutError(f"{self.path} has been held by another process for more than {timeout} s")
+                    sleep(min(delay, remaining))
+                    delay = min(delay * 2, 0.05)
+        wait = perf_counter() - start
+        STATS.record("lock_wait", wait)
+        self.acquisitions += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        data = os.pread(self.fd, VERSION.size, 0)
+        self.version = VERSION.unpack(data)[0] if len(data) == VERSION.size else 0
+        return self.version
+
+    def release(self, version):
+        """
+        Stores the version if it changed and releases the lock.
+        :param version: The version of the database after this process's changes.
+        """
+        if version != self.version:
+            os.pwrite(self.fd, VERSION.pack(version), 0)
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def stats(self):
+        """
+        Returns how often the lock was taken and how long this process waited for it.
+        :return: A dict with the number of acquisitions and timeouts and the total, average and maximum wait
+                 in seconds of the acquisitions.
+        """
+        return {
+            "acquisitions": self.acquisitions,
+            "timeouts": self.timeouts,
+            "wait_total": self.wait_total,
+            "wait_average": self.wait_total / self.acquisitions if self.acquisitions else 0.0,
+            "wait_max": self.wait_max,
+        }
+
+    def close(self):
+        """
+        Closes the lock file.
+        """
+        os.close(self.fd)
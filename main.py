@@ -2,16 +2,23 @@ import discord
 import os
 from dotenv import load_dotenv
 from database import Database
+from sqlite_database import SqliteDatabase
 from xp_system import XpManager
 from commands import Commands
 from time import time
 from rickroll import Rickroll
+from metrics import STATS, handling
 
 load_dotenv()
 TOKEN = os.getenv('TOKEN')
 
-database = Database("bot")
-xp_manager = XpManager(discord, database, time)
+if os.getenv('DATABASE') == 'sqlite':
+    database = SqliteDatabase("bot", flush_interval=30)
+else:
+    database = Database("bot", flush_interval=30, journal=True)
+    STATS.register("guild cache", database.cache_stats)
+    STATS.register("process lock", database.lock_stats)
+xp_manager = XpManager(discord, database, time, batch_interval=30, voice_interval=60)
 commands = Commands(discord, xp_manager)
 rickroll = Rickroll(discord, database)
 
@@ -21,22 +28,48 @@ class MyClient(discord.Client):
         Initializes the Discord client with all intents enabled.
         """
         super().__init__(intents = discord.Intents.all())
+        self.autoflush = None
+        self.autoapply = None
+        self.autotick = None
+        self.autoreport = None
 
     async def on_connect(self):
         """
         Event triggered when the bot connects to Discord.
         """
-        await xp_manager.no_xp(client.guilds)
+        with handling("on_connect"):
+            cleared, seconds = await xp_manager.no_xp(client.guilds)
+        print(f"reset {cleared} voice checkpoints in {len(client.guilds)} guilds in {seconds:.3f}s")
 
     async def on_ready(self):
         """
         Event triggered when the bot is ready.
         Changes bot presence to 'watching Squid Game'.
+        Starts the periodic database flush, the message XP batches, the voice ticks and the storage stats log line.
         """
         print('successfully logged in')
+        if self.autoflush is None:
+            # Tasks keep the handler of the context they were created in
+            with handling("autoflush"):
+                self.autoflush = self.loop.create_task(database.autoflush())
+            with handling("autoapply"):
+                self.autoapply = self.loop.create_task(xp_manager.autoapply())
+            with handling("autotick"):
+                self.autotick = self.loop.create_task(xp_manager.autotick())
+            self.autoreport = self.loop.create_task(STATS.autoreport(600))
         activity = discord.Activity(name = "Squid Game", type = discord.ActivityType.watching)
         await client.change_presence(status='online', activity = activity)
 
+    async def on_guild_available(self, guild):
+        """
+        Event triggered when a guild becomes available, e.g. after connecting.
+        Starts the voice XP of the members who are already in its voice channels.
+        :param guild: The guild that became available.
+        """
+        with handling("on_guild_available"):
+            await database.preload(guild.id)
+            await xp_manager.index_voice_channels(guild)
+
     async def on_disconnect(self):
         """
         Event triggered when the bot disconnects from Discord.
@@ -44,6 +77,22 @@ class MyClient(discord.Client):
         """
         await client.change_presence(status='offline')
 
+    async def close(self):
+        """
+        Closes the connection to Discord.
+        Credits the collected message and voice XP and writes all pending database changes to disk before shutting down.
+        """
+        if not self.is_closed():
+            try:
+                with handling("close"):
+                    await xp_manager.apply_pending_xp()
+                    await xp_manager.voice_tick()
+            finally:
+                try:
+                    await super().close()
+                finally:
+                    database.close()
+
     async def on_message(self, message):
         """
         Event triggered when a message is sent in a text channel.
@@ -54,8 +103,10 @@ class MyClient(discord.Client):
 
         if message.author != client:
             if type(message.channel) is discord.TextChannel:
-                await xp_manager.message_xp(message)
-                await commands.run(message)
+                with handling("on_message"):
+                    await database.preload(message.guild.id)
+                    await xp_manager.message_xp(message)
+                    await commands.run(message)
 
     async def on_voice_state_update(self, member, before, after):
         """
@@ -65,8 +116,10 @@ class MyClient(discord.Client):
         :param before: The previous voice state.
         :param after: The new voice state.
         """
-        await xp_manager.voice_xp(member, before, after)
-        await rickroll.run(client, member, before, after)
+        with handling("on_voice_state_update"):
+            await database.preload(member.guild.id)
+            await xp_manager.voice_xp(member, before, after)
+            await rickroll.run(client, member, before, after)
 
     async def on_member_update(self, before, after):
         """
@@ -75,7 +128,9 @@ class MyClient(discord.Client):
         :param before: The member object before the update.
         :param after: The member object after the update.
         """
-        await xp_manager.update(after)
+        with handling("on_member_update"):
+            await database.preload(after.guild.id)
+            await xp_manager.update(after)
 
 client = MyClient()
 client.run(TOKEN)
@@ -0,0 +1,161 @@
+import asyncio
+import contextvars
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter
+
+# The event handler the current storage operations run for, set by the client's handlers
+handler = contextvars.ContextVar("handler", default="other")
+
+class OperationStats(object):
+    def __init__(self):
+        """
+        Initializes the OperationStats, which count storage operations per handler and operation type.
+        Operations are recorded from the event loop, the storage writer thread and the executor threads that
+        preload guilds (read_file runs on all of them), so the counters are only changed under a lock.
+        Operations can run inside other operations (get_from_member runs get_member, which runs get_members);
+        each one is counted with its self time, so the times of all rows add up to the real total.
+        """
+        self.counters = {}
+        self.lock = threading.Lock()
+        # Per thread, the time of the nested operations of every counted operation currently running
+        self.local = threading.local()
+        # name -> function returning a dict of counters kept elsewhere, or None if they do not apply
+        self.gauges = {}
+
+    def frames(self):
+        """
+        Returns the nested time of the counted operations running on the current thread, innermost last.
+        :return: The list of nested times.
+        """
+        try:
+            return self.local.frames
+        except AttributeError:
+            frames = self.local.frames = []
+            return frames
+
+    def record(self, operation, seconds, read=0, written=0):
+        """
+        Records one operation that runs no nested operations for the current handler.
+        Its time also counts as nested time of the counted operation it ran in, if any.
+        :param operation: The name of the operation, e.g. "read_file".
+        :param seconds: The time the operation took.
+        :param read: The number of bytes read from disk.
+        :param written: The number of bytes written to disk.
+        """
+        frames = self.frames()
+        if frames:
+            frames[-1] += seconds
+        self.add(operation, seconds, read, written)
+
+    def add(self, operation, seconds, read=0, written=0):
+        """
+        Adds one operation to the counters of the current handler.
+        :param operation: The name of the operation.
+        :param seconds: The self time of the operation, without nested operations.
+        :param read: The number of bytes read from disk.
+        :param written: The number of bytes written to disk.
+        """
+        key = (handler.get(), operation)
+        with self.lock:
+            counter = self.counters.get(key)
+            if counter is None:
+                counter = self.counters[key] = [0, 0.0, 0, 0]
+            counter[0] += 1
+            counter[1] += seconds
+            counter[2] += read
+            counter[3] += written
+
+    def rows(self):
+        """
+        Returns the counters, the most time-consuming first.
+        :return: A list of (handler, operation, calls, self seconds, bytes read, bytes written) tuples.
+        """
+        with self.lock:
+            rows = [key + tuple(counter) for key, counter in self.counters.items()]
+        return sorted(rows, key=lambda row: row[3], reverse=True)
+
+    def register(self, name, function):
+        """
+        Adds counters kept outside of OperationStats, e.g. those of the guild cache, to the summary and dbstats.
+        :param name: The name shown before the counters.
+        :param function: A function returning a dict of counters, or None if they do not apply.
+        """
+        self.gauges[name] = function
+
+    def gauge_rows(self):
+        """
+        Returns the registered counters that apply.
+        :return: A list of (name, text) pairs, e.g. ("guild cache", "hits 5, misses 2").
+        """
+        rows = []
+        for name, function in self.gauges.items():
+            values = function()
+            if values is not None:
+                rows.append((name, ", ".join(f"{key} {value:.3f}" if isinstance(value, float) else f"{key} {value}" for key, value in values.items())))
+        return rows
+
+    def summary(self):
+        """
+        Sums up all counters in one line, followed by the registered counters.
+        :return: The summary.
+        """
+        rows = self.rows()
+        line = (
+            f"storage: {sum(row[2] for row in rows)} calls, {sum(row[3] for row in rows):.3f} s, "
+            f"{sum(row[4] for row in rows)} bytes read, {sum(row[5] for row in rows)} bytes written"
+        )
+        if rows:
+            line += f", most time in {rows[0][0]}/{rows[0][1]} ({rows[0][2]} calls, {rows[0][3]:.3f} s)"
+        for name, text in self.gauge_rows():
+            line += f"; {name}: {text}"
+        return line
+
+    async def autoreport(self, interval):
+        """
+        Prints the summary every interval seconds.
+        Meant to run as a background task for the lifetime of the client.
+        :param interval: Seconds between two summaries.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            print(self.summary())
+
+STATS = OperationStats()
+
+def counted(method):
+    """
+    Makes a storage method record its calls and self time in STATS under its own name.
+    :param method: The method.
+    :return: The wrapped method.
+    """
+    name = method.__name__
+
+    @wraps(method)
+    def wrapper(*args):
+        frames = STATS.frames()
+        frames.append(0.0)
+        start = perf_counter()
+        try:
+            return method(*args)
+        finally:
+            elapsed = perf_counter() - start
+            nested = frames.pop()
+            if frames:
+                frames[-1] += elapsed
+            STATS.add(name, elapsed - nested)
+    return wrapper
+
+@contextmanager
+def handling(name):
+    """
+    Attributes all storage operations in the block to a handler, including
+    writes it queues for the storage writer thread.
+    :param name: The name of the handler, e.g. "on_message".
+    """
+    token = handler.set(name)
+    try:
+        yield
+    finally:
+        handler.reset(token)
@@ -0,0 +1,40 @@
+MIGRATIONS = {}
+
+def migration(version):
+    """
+    Registers a function that upgrades a guild entry from version - 1 to the given version.
+    Migrations change the entry in place. Nested values such as "roles" have to be replaced
+    instead of changed in place, since snapshots only copy the entry itself.
+    :param version: The schema version the function upgrades to.
+    :return: A decorator registering the function.
+    """
+    def register(function):
+        MIGRATIONS[version] = function
+        return function
+    return register
+
+@migration(1)
+def add_missing_values(guild):
+    """
+    Adds the values of guild entries created before they existed, e.g. the rickroll targets.
+    :param guild: The guild entry.
+    """
+    for key, value in {"prefix": "!", "roles": {}, "rickroll_members": "", "rickroll_roles": ""}.items():
+        guild.setdefault(key, value)
+
+SCHEMA_VERSION = max(MIGRATIONS)
+
+def upgrade_guild(guild):
+    """
+    Applies all migrations a guild entry has not seen yet and stamps it with the current schema version.
+    Entries without a "schema_version" are version 0.
+    :param guild: The guild entry.
+    :return: True if the entry was changed.
+    """
+    version = guild.get("schema_version", 0)
+    if version >= SCHEMA_VERSION:
+        return False
+    for next_version in range(version + 1, SCHEMA_VERSION + 1):
+        MIGRATIONS[next_version](guild)
+    guild["schema_version"] = SCHEMA_VERSION
+    return True
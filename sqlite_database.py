@@ -0,0 +1,254 @@
+import asyncio
+import json
+import sqlite3
+from contextlib import contextmanager
+from metrics import counted
+
+GUILD_COLUMNS = ["prefix", "roles", "rickroll_members", "rickroll_roles"]
+MEMBER_COLUMNS = ["xp", "last_counted_message_time", "last_voice_checkpoint"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS guilds (
+    guild_id INTEGER PRIMARY KEY,
+    prefix TEXT NOT NULL DEFAULT '!',
+    roles TEXT NOT NULL DEFAULT '{}',
+    rickroll_members TEXT NOT NULL DEFAULT '',
+    rickroll_roles TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS members (
+    guild_id INTEGER NOT NULL,
+    member_id INTEGER NOT NULL,
+    xp REAL NOT NULL DEFAULT 0,
+    last_counted_message_time REAL NOT NULL DEFAULT 0,
+    last_voice_checkpoint REAL,
+    PRIMARY KEY (guild_id, member_id)
+) WITHOUT ROWID;
+"""
+
+# Statements are built once so sqlite3's statement cache can reuse their compiled form.
+INSERT_GUILD = "INSERT OR IGNORE INTO guilds (guild_id) VALUES (?)"
+SELECT_GUILD = "SELECT guild_id, prefix, roles, rickroll_members, rickroll_roles FROM guilds WHERE guild_id = ?"
+UPDATE_GUILD = {key: "UPDATE guilds SET " + key + " = ? WHERE guild_id = ?" for key in GUILD_COLUMNS}
+INSERT_MEMBER = "INSERT OR IGNORE INTO members (guild_id, member_id) VALUES (?, ?)"
+SELECT_MEMBER = "SELECT xp, last_counted_message_time, last_voice_checkpoint FROM members WHERE guild_id = ? AND member_id = ?"
+SELECT_MEMBER_XP = "SELECT member_id, xp FROM members WHERE guild_id = ?"
+SELECT_MEMBERS = "SELECT member_id, xp, last_counted_message_time, last_voice_checkpoint FROM members WHERE guild_id = ?"
+UPDATE_MEMBER = {key: "UPDATE members SET " + key + " = ? WHERE guild_id = ? AND member_id = ?" for key in MEMBER_COLUMNS}
+RESET_VOICE_CHECKPOINTS = "UPDATE members SET last_voice_checkpoint = NULL WHERE guild_id = ? AND last_voice_checkpoint IS NOT NULL"
+ADD_TO_MEMBER = {key: "UPDATE members SET " + key + " = " + key + " + ? WHERE guild_id = ? AND member_id = ?" for key in MEMBER_COLUMNS}
+
+class SqliteDatabase(object):
+    def __init__(self, name, flush_interval=None):
+        """
+        Initializes the SqliteDatabase object, a drop-in replacement for Database backed by SQLite.
+        :param name: The name of the database file (without extension).
+        :param flush_interval: Seconds between commits of pending changes.
+                               None commits every change immediately.
+        """
+        self.name = name
+        self.flush_interval = flush_interval
+        self.transactions = 0
+        self.connection = sqlite3.connect(name + ".sqlite3", cached_statements=len(GUILD_COLUMNS) + 2 * len(MEMBER_COLUMNS) + 8)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    def changed(self):
+        """
+        Called after every write. Without a flush interval the change is committed right away,
+        unless a transaction is open, which commits it when it ends.
+        """
+        if self.flush_interval is None and not self.transactions:
+            self.flush()
+
+    @contextmanager
+    def transaction(self, guild_id):
+        """
+        Groups all reads and changes of one event into a single commit.
+        Transactions can be nested; only the outermost one commits.
+        :param guild_id: The ID of the guild the event belongs to.
+        """
+        self.get_guild(guild_id)
+        self.transactions += 1
+        try:
+            yield
+        finally:
+            self.transactions -= 1
+            self.changed()
+
+    @counted
+    def flush(self):
+        """
+        Commits all pending changes in one transaction.
+        """
+        if self.connection.in_transaction:
+            self.connection.commit()
+
+    def close(self):
+        """
+        Commits all pending changes and closes the connection.
+        """
+        self.flush()
+        self.connection.close()
+
+    async def autoflush(self):
+        """
+        Commits the pending changes every flush_interval seconds.
+        Meant to run as a background task for the lifetime of the client.
+        """
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
+
+    async def preload(self, guild_id):
+        """
+        Does nothing, as SQLite reads only the rows an operation needs.
+        :param guild_id: The ID of the guild.
+        """
+
+    @counted
+    def save_guild(self, guild_id):
+        """
+        Saves a new guild entry with default values.
+        :param guild_id: The ID of the guild to save.
+        """
+        self.connection.execute(INSERT_GUILD, (guild_id,))
+        self.changed()
+
+    @counted
+    def get_guild(self, guild_id):
+        """
+        Retrieves guild data by ID. If not found, creates a new entry.
+        :param guild_id: The ID of the guild to retrieve.
+        :return: The guild data.
+        """
+        row = self.connection.execute(SELECT_GUILD, (guild_id,)).fetchone()
+        if row is None:
+            self.save_guild(guild_id)
+            row = self.connection.execute(SELECT_GUILD, (guild_id,)).fetchone()
+        guild = dict(zip(["guild_id"] + GUILD_COLUMNS, row))
+        guild["roles"] = json.loads(guild["roles"])
+        return guild
+
+    @counted
+    def update_guild(self, guild_id, update):
+        """
+        Updates an existing guild entry with new data.
+        :param guild_id: The ID of the guild to update.
+        :param update: The data to update in the guild entry.
+        """
+        self.get_guild(guild_id)
+        for key, value in update.items():
+            if key == "roles":
+                value = json.dumps(value)
+            self.connection.execute(UPDATE_GUILD[key], (value, guild_id))
+        self.changed()
+
+    @counted
+    def change_in_guild(self, guild_id, key, value):
+        """
+        Changes a specific key-value pair in a guild entry.
+        :param guild_id: The ID of the guild.
+        :param key: The key to update.
+        :param value: The new value for the key.
+        """
+        self.update_guild(guild_id, {key: value})
+
+    @counted
+    def get_from_guild(self, guild_id, key):
+        """
+        Retrieves a specific value from a guild by key.
+        :param guild_id: The ID of the guild.
+        :param key: The key to retrieve the value for.
+        :return: The value associated with the key.
+        """
+        return self.get_guild(guild_id)[key]
+
+    @counted
+    def get_members(self, guild_id):
+        """
+        Retrieves all member records of a guild.
+        :param guild_id: The ID of the guild.
+        :return: A dict mapping member IDs to their records.
+        """
+        rows = self.connection.execute(SELECT_MEMBERS, (guild_id,))
+        return {row[0]: dict(zip(MEMBER_COLUMNS, row[1:])) for row in rows}
+
+    @counted
+    def get_member_xp(self, guild_id):
+        """
+        Retrieves the XP of all members of a guild with one query.
+        :param guild_id: The ID of the guild.
+        :return: A list of (member ID, xp) pairs.
+        """
+        return self.connection.execute(SELECT_MEMBER_XP, (guild_id,)).fetchall()
+
+    @counted
+    def save_member(self, member):
+        """
+        Saves a new member entry with default values.
+        :param member: The member object to save.
+        """
+        self.connection.execute(INSERT_MEMBER, (member.guild.id, member.id))
+        self.changed()
+
+    @counted
+    def get_member(self, member):
+        """
+        Retrieves the record of a member. If not found, creates a new entry.
+        :param member: The member object to retrieve the record for.
+        :return: The member record.
+        """
+        row = self.connection.execute(SELECT_MEMBER, (member.guild.id, member.id)).fetchone()
+        if row is None:
+            self.save_member(member)
+            row = self.connection.execute(SELECT_MEMBER, (member.guild.id, member.id)).fetchone()
+        return dict(zip(MEMBER_COLUMNS, row))
+
+    @counted
+    def get_from_member(self, member, key):
+        """
+        Retrieves a specific value from a member by key.
+        If the member does not exist, creates a new entry.
+        :param member: The member object to retrieve data for.
+        :param key: The key to retrieve the value for.
+        :return: The value associated with the key for the member.
+        """
+        return self.get_member(member)[key]
+
+    @counted
+    def change_in_member(self, member, key, value):
+        """
+        Changes a specific key-value pair in a member entry.
+        If the member does not exist, creates a new entry.
+        :param member: The member object to update.
+        :param key: The key to update.
+        :param value: The new value for the key.
+        """
+        self.connection.execute(INSERT_MEMBER, (member.guild.id, member.id))
+        self.connection.execute(UPDATE_MEMBER[key], (value, member.guild.id, member.id))
+        self.changed()
+
+    @counted
+    def add_to_member(self, member, key, amount):
+        """
+        Adds an amount to a numeric value of a member entry.
+        If the member does not exist, creates a new entry.
+        :param member: The member object to update.
+        :param key: The key of the value to increase.
+        :param amount: The amount to add.
+        """
+        self.connection.execute(INSERT_MEMBER, (member.guild.id, member.id))
+        self.connection.execute(ADD_TO_MEMBER[key], (amount, member.guild.id, member.id))
+        self.changed()
+
+    @counted
+    def reset_voice_checkpoints(self, guild_id):
+        """
+        Clears the voice checkpoint of every member of a guild with one statement.
+        :param guild_id: The ID of the guild.
+        :return: The number of cleared checkpoints.
+        """
+        cleared = self.connection.execute(RESET_VOICE_CHECKPOINTS, (guild_id,)).rowcount
+        self.changed()
+        return cleared
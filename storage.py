@@ -0,0 +1,130 @@
+import contextvars
+import json
+import os
+import traceback
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from tinydb.storages import Storage
+from metrics import STATS
+
+BLOCK_SIZE = 65536
+
+class JSONFileStorage(Storage):
+    def __init__(self, path):
+        """
+        Initializes the JSONFileStorage, a TinyDB storage that only opens its file while reading or writing.
+        Unlike TinyDB's JSONStorage it does not hold a file descriptor, so a database can have a file per guild.
+        A path ending in ".z" is stored zlib-compressed, compressing and decompressing block by block.
+        :param path: The path of the JSON file.
+        """
+        self.path = path
+        self.compressed = path.endswith(".z")
+
+    def read(self):
+        """
+        Reads the JSON file.
+        :return: The stored document tree, or None if the file does not exist or is empty.
+        """
+        start = perf_counter()
+        try:
+            with open(self.path, "rb") as handle:
+                if self.compressed:
+                    decompressor = zlib.decompressobj()
+                    blocks = [decompressor.decompress(block) for block in iter(lambda: handle.read(BLOCK_SIZE), b"")]
+                    blocks.append(decompressor.flush())
+                    text = b"".join(blocks)
+                else:
+                    text = handle.read()
+                read = handle.tell()
+        except FileNotFoundError:
+            return None
+        data = json.loads(text) if text else None
+        STATS.record("read_file", perf_counter() - start, read=read)
+        return data
+
+    def write(self, data):
+        """
+        Atomically replaces the contents of the JSON file. The data is written and synced to a temporary file,
+        which is then renamed over the old one, so a crash mid-write leaves the previous version intact.
+        :param data: The document tree to store.
+        """
+        self.write_chunks([json.dumps(data)])
+
+    def write_chunks(self, chunks):
+        """
+        Atomically replaces the contents of the JSON file with already encoded text, like write.
+        :param chunks: The pieces of JSON text, written one after another.
+        """
+        start = perf_counter()
+        with open(self.path + ".tmp", "wb") as handle:
+            if self.compressed:
+                compressor = zlib.compressobj()
+                for chunk in chunks:
+                    handle.write(compressor.compress(chunk.encode("utf-8")))
+                handle.write(compressor.flush())
+            else:
+                for chunk in chunks:
+                    handle.write(chunk.encode("utf-8"))
+            handle.flush()
+            os.fsync(handle.fileno())
+            written = handle.tell()
+        os.replace(self.path + ".tmp", self.path)
+        STATS.record("write_file", perf_counter() - start, written=written)
+
+def compress_file(path):
+    """
+    Converts an uncompressed JSON file into a compressed <path>.z file, block by block.
+    The old file is kept as <path>.migrated.
+    :param path: The path of the uncompressed file.
+    """
+    compressor = zlib.compressobj()
+    with open(path, "rb") as source, open(path + ".z.tmp", "wb") as handle:
+        for block in iter(lambda: source.read(BLOCK_SIZE), b""):
+            handle.write(compressor.compress(block))
+        handle.write(compressor.flush())
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.replace(path + ".z.tmp", path + ".z")
+    os.replace(path, path + ".migrated")
+
+class StorageWriter(object):
+    def __init__(self):
+        """
+        Initializes the StorageWriter, which runs blocking storage work on one dedicated worker thread.
+        Work runs in the order it was submitted, so a later write can never overtake an earlier one.
+        """
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+
+    def submit(self, function, *args):
+        """
+        Queues a blocking call for the worker thread and returns immediately.
+        The call runs in a copy of the caller's context, so its storage operations count for the caller's handler.
+        Errors are printed, since nobody waits for the result.
+        :param function: The function to call.
+        :param args: The arguments to call it with.
+        :return: A future for the result of the call.
+        """
+        future = self.executor.submit(contextvars.copy_context().run, function, *args)
+        future.add_done_callback(self.report)
+        return future
+
+    def report(self, future):
+        """
+        Prints the error of a failed storage call.
+        :param future: The finished future.
+        """
+        if future.exception() is not None:
+            traceback.print_exception(type(future.exception()), future.exception(), future.exception().__traceback__)
+
+    def wait(self):
+        """
+        Blocks until all work submitted so far has finished.
+        """
+        self.executor.submit(lambda: None).result()
+
+    def close(self):
+        """
+        Finishes all queued work and stops the worker thread.
+        """
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,155 @@
+class VoiceSessions(object):
+    def __init__(self):
+        """
+        Initializes the VoiceSessions, the members currently earning voice XP, grouped by guild.
+        Each session remembers since when its time has not been credited yet and how fast it earns.
+        Also indexes who is in which voice channel, so a channel's eligibility can be recomputed without Discord's cache.
+        """
+        # guild ID -> member ID -> [member, uncredited since, rate]
+        self.guilds = {}
+        # guild ID -> channel ID -> member ID -> (member, voice state)
+        self.channels = {}
+
+    def start(self, member, now, rate):
+        """
+        Starts (or restarts) the session of a member.
+        :param member: The member.
+        :param now: The current time.
+        :param rate: The factor the member's voice time counts with, e.g. 3 with video.
+        """
+        self.guilds.setdefault(member.guild.id, {})[member.id] = [member, now, rate]
+
+    def stop(self, member, now):
+        """
+        Ends the session of a member.
+        :param member: The member.
+        :param now: The current time.
+        :return: The uncredited voice time multiplied by the rate, or None if the member had no session.
+        """
+        sessions = self.guilds.get(member.guild.id)
+        if sessions is None or member.id not in sessions:
+            return None
+        _, since, rate = sessions.pop(member.id)
+        if not sessions:
+            del self.guilds[member.guild.id]
+        return (now - since) * rate
+
+    def rate(self, member):
+        """
+        Returns the rate of a member's session.
+        :param member: The member.
+        :return: The rate, or None if the member has no session.
+        """
+        session = self.guilds.get(member.guild.id, {}).get(member.id)
+        return None if session is None else session[2]
+
+    def stop_all(self, guild_id, now):
+        """
+        Ends all sessions of a guild and forgets its channels, like clear, but returns the time to credit.
+        :param guild_id: The ID of the guild.
+        :param now: The current time.
+        :return: A list of (member, uncredited voice time multiplied by the rate) pairs.
+        """
+        self.channels.pop(guild_id, None)
+        sessions = self.guilds.pop(guild_id, {})
+        return [(member, (now - since) * rate) for member, since, rate in sessions.values()]
+
+    def index_channel(self, channel, exclude_id=None):
+        """
+        Replaces the index entry of a voice channel with the members Discord lists in it.
+        :param channel: The voice channel.
+        :param exclude_id: The ID of a member to leave out, e.g. the one whose voice update is being handled.
+        """
+        occupants = {
+            member.id: (member, member.voice)
+            for member in channel.members if member.id != exclude_id and member.voice is not None
+        }
+        channels = self.channels.setdefault(channel.guild.id, {})
+        if occupants:
+            channels[channel.id] = occupants
+        else:
+            channels.pop(channel.id, None)
+            if not channels:
+                del self.channels[channel.guild.id]
+
+    def seed(self, channel, member):
+        """
+        Indexes a voice channel the index does not know yet from Discord's member list, e.g. after a restart,
+        when members were already in it. Afterwards the channel is kept current by the voice updates.
+        :param channel: The voice channel.
+        :param member: The member whose voice update is being handled; move adds them.
+        """
+        if channel.id not in self.channels.get(channel.guild.id, {}):
+            self.index_channel(channel, member.id)
+
+    def move(self, member, before, after):
+        """
+        Moves a member in the channel index from their old voice state to their new one.
+        :param member: The member.
+        :param before: The state of the member before the voice update.
+        :param after: The state of the member after the voice update.
+        :return: The IDs of the channels whose occupants changed.
+        """
+        channels = self.channels.setdefault(member.guild.id, {})
+        affected = []
+        if before.channel is not None:
+            occupants = channels.get(before.channel.id)
+            if occupants is not None:
+                occupants.pop(member.id, None)
+                if not occupants:
+                    del channels[before.channel.id]
+            affected.append(before.channel.id)
+        if after.channel is not None:
+            channels.setdefault(after.channel.id, {})[member.id] = (member, after)
+            if after.channel.id not in affected:
+                affected.append(after.channel.id)
+        if not channels:
+            del self.channels[member.guild.id]
+        return affected
+
+    def occupants(self, guild_id, channel_id):
+        """
+        Returns the members in a voice channel.
+        :param guild_id: The ID of the guild.
+        :param channel_id: The ID of the channel.
+        :return: A list of (member, voice state) pairs.
+        """
+        return list(self.channels.get(guild_id, {}).get(channel_id, {}).values())
+
+    def clear(self, guild_id):
+        """
+        Ends all sessions of a guild without crediting them and forgets its channels.
+        :param guild_id: The ID of the guild.
+        """
+        self.guilds.pop(guild_id, None)
+        self.channels.pop(guild_id, None)
+
+    def __contains__(self, member):
+        """
+        Checks whether a member has a session.
+        :param member: The member.
+        :return: True if the member is earning voice XP.
+        """
+        return member.id in self.guilds.get(member.guild.id, {})
+
+    def collect(self, now):
+        """
+        Takes the uncredited time of all sessions in one pass; the sessions continue from now.
+        :param now: The current time.
+        :return: A list of (guild ID, list of (member, voice time multiplied by the rate)) pairs.
+        """
+        credits = []
+        for guild_id, sessions in self.guilds.items():
+            guild_credits = []
+            for session in sessions.values():
+                guild_credits.append((session[0], (now - session[1]) * session[2]))
+                session[1] = now
+            credits.append((guild_id, guild_credits))
+        return credits
+
+    def __len__(self):
+        """
+        Returns the number of sessions.
+        :return: The number of members earning voice XP.
+        """
+        return sum(len(sessions) for sessions in self.guilds.values())
@@ -1,14 +1,31 @@
+import asyncio
+import traceback
+from time import perf_counter
+from cooldown import Cooldown
+from voice import VoiceSessions
+
 class XpManager(object):
-    def __init__(self, discord, database, time):
+    def __init__(self, discord, database, time, batch_interval=None, voice_interval=None):
         """
         Initializes the XP Manager.
         :param discord: Discord API reference.
         :param database: Database instance to manage guild and member data.
         :param time: Time module to track XP gain intervals.
+        :param batch_interval: Seconds between batches of message XP. Message XP is then collected in memory
+                               and written by apply_pending_xp. None writes every gain right away.
+        :param voice_interval: Seconds between voice ticks, which credit the XP of all members in voice.
+                               None only credits voice XP when a member's voice state changes.
         """
         self.discord = discord
         self.database = database
         self.time = time
+        self.batch_interval = batch_interval
+        # guild ID -> member ID -> [member, pending xp]
+        self.pending_xp = {}
+        # Message cooldowns are only kept in memory, so last_counted_message_time is no longer stored
+        self.message_cooldown = Cooldown(60)
+        self.voice_interval = voice_interval
+        self.voice_sessions = VoiceSessions()
 
     def get_roles(self, member) -> dict:
         """
@@ -20,20 +37,26 @@ class XpManager(object):
         roles = {int(min_xp): member.guild.get_role(role_ids[min_xp]) for min_xp in role_ids}
         return roles
 
-    def calculate_xp(self, member) -> int:
+    def calculate_xp(self, member, xp=None) -> int:
         """
         Calculates the total XP for a member.
         :param member: The member whose XP is being calculated.
+        :param xp: The member's stored XP if it was read already, e.g. by get_member_xp.
         :return: The member's XP as an integer.
         """
-        xp = self.database.get_from_member(member, "xp")
+        if xp is None:
+            xp = self.database.get_from_member(member, "xp")
+        pending = self.pending_xp.get(member.guild.id, {}).get(member.id)
+        if pending is not None:
+            xp += pending[1]
         xp = int(round(xp))
         return xp
 
-    async def update(self, member):
+    def plan_roles(self, member):
         """
-        Updates the roles of a member based on their XP.
-        :param member: The member whose roles need to be updated.
+        Determines which role a member should have based on their XP, using only database reads.
+        :param member: The member whose roles are being checked.
+        :return: A tuple of the role to add and the roles to remove, or None if no role applies.
         """
         roles = self.get_roles(member)
         xp = self.calculate_xp(member)
@@ -42,9 +65,33 @@ class XpManager(object):
             key = max(possible)
             current_role = roles[key]
             to_remove = [role for role in member.roles if role in roles.values() and role != current_role]
-            if to_remove:
-                await member.remove_roles(*to_remove, reason="xp auto system")
-            await member.add_roles(current_role, reason="xp auto system")
+            return current_role, to_remove
+        return None
+
+    async def apply_roles(self, member, plan):
+        """
+        Applies a role plan from plan_roles to a member.
+        Errors from Discord (e.g. missing permissions) are printed, so they do not stop the roles of other members.
+        :param member: The member whose roles need to be updated.
+        :param plan: The result of plan_roles.
+        """
+        if plan is not None:
+            current_role, to_remove = plan
+            try:
+                if to_remove:
+                    await member.remove_roles(*to_remove, reason="xp auto system")
+                await member.add_roles(current_role, reason="xp auto system")
+            except self.discord.HTTPException as error:
+                print(f"could not update the roles of member {member.id} in guild {member.guild.id}: {error}")
+
+    async def update(self, member):
+        """
+        Updates the roles of a member based on their XP.
+        :param member: The member whose roles need to be updated.
+        """
+        with self.database.transaction(member.guild.id):
+            plan = self.plan_roles(member)
+        await self.apply_roles(member, plan)
 
     async def update_all(self, guild):
         """
@@ -61,46 +108,235 @@ class XpManager(object):
         :param member: The member to receive XP.
         :param xp: The amount of XP to add.
         """
-        xp = self.database.get_from_member(member, "xp") + xp
-        self.database.change_in_member(member, "xp", xp)
+        self.database.add_to_member(member, "xp", xp)
+
+    def add_xp_in_batch(self, member, xp, thresholds):
+        """
+        Adds XP to a member as part of a batch and plans their roles only if the XP crossed a role threshold.
+        :param member: The member to receive XP.
+        :param xp: The amount of XP to add.
+        :param thresholds: The minimal XP values of the guild's roles.
+        :return: The result of plan_roles, or None if no threshold was crossed.
+        """
+        old_xp = self.calculate_xp(member)
+        if xp:
+            self.add_xp(member, xp)
+        new_xp = self.calculate_xp(member)
+        if any(old_xp < threshold <= new_xp for threshold in thresholds):
+            return self.plan_roles(member)
+        return None
 
     async def message_xp(self, message):
         """
         Awards XP for sending messages if the cooldown has passed.
         :param message: The message that triggered the XP gain.
         """
-        last_counted_message_time = self.database.get_from_member(message.author, "last_counted_message_time")
-        difference = self.time() - last_counted_message_time
-        if difference >= 60:
-            self.database.change_in_member(message.author, "last_counted_message_time", self.time())
-            self.add_xp(message.author, 1)
-            await self.update(message.author)
+        member = message.author
+        now = self.time()
+        if not self.message_cooldown.try_pass((member.guild.id, member.id), now):
+            return
+        if self.batch_interval is not None:
+            self.queue_message_xp(member)
+            return
+        with self.database.transaction(member.guild.id):
+            self.add_xp(member, 1)
+            plan = self.plan_roles(member)
+        await self.apply_roles(member, plan)
+
+    def queue_message_xp(self, member):
+        """
+        Collects the XP of a counted message in memory until the next batch.
+        :param member: The author of the message.
+        """
+        pending = self.pending_xp.get(member.guild.id, {}).get(member.id)
+        if pending is None:
+            pending = self.pending_xp.setdefault(member.guild.id, {})[member.id] = [member, 0]
+        pending[1] += 1
+
+    def reset_pending_xp(self, member):
+        """
+        Drops the XP a member has collected since the last batch, e.g. because their XP was set to a new value.
+        :param member: The member.
+        """
+        pending = self.pending_xp.get(member.guild.id, {}).get(member.id)
+        if pending is not None:
+            pending[1] = 0
+
+    async def apply_pending_xp(self):
+        """
+        Writes the collected message XP with one transaction per guild.
+        Roles are only recalculated for members whose XP crossed a role threshold.
+        """
+        plans = []
+        while self.pending_xp:
+            guild_id, batch = self.pending_xp.popitem()
+            with self.database.transaction(guild_id):
+                thresholds = None
+                for member, xp in batch.values():
+                    if thresholds is None:
+                        thresholds = self.get_roles(member).keys()
+                    plan = self.add_xp_in_batch(member, xp, thresholds)
+                    if plan is not None:
+                        plans.append((member, plan))
+        for member, plan in plans:
+            await self.apply_roles(member, plan)
+
+    async def autoapply(self):
+        """
+        Writes the collected message XP every batch_interval seconds.
+        Meant to run as a background task for the lifetime of the client, so errors are printed instead of ending it.
+        """
+        while True:
+            await asyncio.sleep(self.batch_interval)
+            try:
+                await self.apply_pending_xp()
+            except Exception:
+                traceback.print_exc()
+
+    def voice_rate(self, state, humans):
+        """
+        Determines how fast a member in a voice channel earns XP.
+        :param state: The voice state of the member.
+        :param humans: The number of non-bot members in the channel.
+        :return: The rate, 3 with video and 1 otherwise, or None if the member earns no XP.
+        """
+        if any([humans < 2, state.afk, state.deaf, state.mute, state.self_deaf, state.self_mute]):
+            return None
+        return 3 if state.self_video else 1
+
+    def refresh_channel(self, guild_id, channel_id, now, thresholds, plans):
+        """
+        Recomputes the eligibility of everyone in a voice channel and starts or ends their sessions accordingly.
+        Ended sessions are credited, changed rates are credited and restarted. Must run inside a transaction of the guild.
+        :param guild_id: The ID of the guild.
+        :param channel_id: The ID of the channel.
+        :param now: The current time.
+        :param thresholds: The minimal XP values of the guild's roles.
+        :param plans: A list the (member, plan) pairs of members whose XP crossed a role threshold are appended to.
+        """
+        occupants = self.voice_sessions.occupants(guild_id, channel_id)
+        humans = len([member for member, state in occupants if not member.bot])
+        for member, state in occupants:
+            rate = self.voice_rate(state, humans)
+            if rate == self.voice_sessions.rate(member):
+                continue
+            voice_time = self.voice_sessions.stop(member, now)
+            if voice_time is not None:
+                plan = self.add_xp_in_batch(member, voice_time / 60, thresholds)
+                if plan is not None:
+                    plans.append((member, plan))
+            if rate is None:
+                self.database.change_in_member(member, "last_voice_checkpoint", None)
+            else:
+                self.voice_sessions.start(member, now, rate)
+                self.database.change_in_member(member, "last_voice_checkpoint", now)
 
     async def voice_xp(self, member, before, after):
         """
         Awards XP for time spent in voice channels.
+        Ends the member's voice session, crediting its remaining time, and recomputes the eligibility of everyone
+        in the channels the member left and joined, e.g. so the first member starts earning when a second one joins.
         :param member: The member in the voice channel.
         :param before: The state of the member before the voice update.
         :param after: The state of the member after the voice update.
         """
-        last_checkpoint = self.database.get_from_member(member, "last_voice_checkpoint")
-        if last_checkpoint is not None:
-            voice_time = self.time() - last_checkpoint
-            if before.self_video:
-                voice_time *= 3
-            xp = voice_time / 60
-            self.add_xp(member, xp)
-            self.database.change_in_member(member, "last_voice_checkpoint", None)
-            await self.update(member)
-        if after.channel is not None:
-            if not any([len([member for member in after.channel.members if not member.bot]) < 2, after.afk, after.deaf, after.mute, after.self_deaf, after.self_mute]):
-                self.database.change_in_member(member, "last_voice_checkpoint", self.time())
+        plan = None
+        plans = []
+        now = self.time()
+        with self.database.transaction(member.guild.id):
+            voice_time = self.voice_sessions.stop(member, now)
+            if voice_time is None:
+                # Without a session (e.g. after a restart) the checkpoint in the database is all there is
+                last_checkpoint = self.database.get_from_member(member, "last_voice_checkpoint")
+                if last_checkpoint is not None:
+                    voice_time = (now - last_checkpoint) * (3 if before.self_video else 1)
+            if voice_time is not None:
+                self.add_xp(member, voice_time / 60)
+                self.database.change_in_member(member, "last_voice_checkpoint", None)
+                plan = self.plan_roles(member)
+            for channel in (before.channel, after.channel):
+                if channel is not None:
+                    self.voice_sessions.seed(channel, member)
+            affected = self.voice_sessions.move(member, before, after)
+            if affected:
+                thresholds = self.get_roles(member).keys()
+                for channel_id in affected:
+                    self.refresh_channel(member.guild.id, channel_id, now, thresholds, plans)
+        await self.apply_roles(member, plan)
+        for other, other_plan in plans:
+            await self.apply_roles(other, other_plan)
+
+    async def index_voice_channels(self, guild):
+        """
+        Rebuilds the channel index of a guild from the members Discord lists in its voice channels and
+        starts the sessions of those who are eligible, as nobody in voice causes a voice update when the bot connects.
+        Sessions still running, e.g. from before the guild became unavailable, are credited and restarted.
+        :param guild: The guild, with its voice states loaded (i.e. once it is available).
+        """
+        plans = []
+        now = self.time()
+        with self.database.transaction(guild.id):
+            thresholds = None
+            for member, voice_time in self.voice_sessions.stop_all(guild.id, now):
+                if thresholds is None:
+                    thresholds = self.get_roles(member).keys()
+                self.database.change_in_member(member, "last_voice_checkpoint", None)
+                plan = self.add_xp_in_batch(member, voice_time / 60, thresholds)
+                if plan is not None:
+                    plans.append((member, plan))
+            for channel in guild.voice_channels:
+                self.voice_sessions.index_channel(channel)
+                if channel.members:
+                    if thresholds is None:
+                        thresholds = self.get_roles(channel.members[0]).keys()
+                    self.refresh_channel(guild.id, channel.id, now, thresholds, plans)
+        for member, plan in plans:
+            await self.apply_roles(member, plan)
+
+    async def voice_tick(self):
+        """
+        Credits the voice XP of all sessions in one pass, with one transaction per guild.
+        The checkpoints move to now, so a crash loses at most one tick of voice time.
+        Roles are only recalculated for members whose XP crossed a role threshold.
+        """
+        now = self.time()
+        plans = []
+        for guild_id, credits in self.voice_sessions.collect(now):
+            with self.database.transaction(guild_id):
+                thresholds = None
+                for member, voice_time in credits:
+                    if thresholds is None:
+                        thresholds = self.get_roles(member).keys()
+                    self.database.change_in_member(member, "last_voice_checkpoint", now)
+                    plan = self.add_xp_in_batch(member, voice_time / 60, thresholds)
+                    if plan is not None:
+                        plans.append((member, plan))
+        for member, plan in plans:
+            await self.apply_roles(member, plan)
+
+    async def autotick(self):
+        """
+        Runs a voice tick every voice_interval seconds.
+        Meant to run as a background task for the lifetime of the client, so errors are printed instead of ending it.
+        """
+        while True:
+            await asyncio.sleep(self.voice_interval)
+            try:
+                await self.voice_tick()
+            except Exception:
+                traceback.print_exc()
 
     async def no_xp(self, guilds):
         """
-        Resets the voice XP checkpoint for all members in all guilds.
+        Resets the voice XP checkpoint for all members in all guilds and forgets their voice sessions.
+        Each guild is reset in one pass without a write of its own.
+        The sessions of the members in voice are started again by index_voice_channels once a guild is available.
         :param guilds: The list of guilds to reset XP for.
+        :return: The number of cleared checkpoints and the seconds the reset took.
         """
+        start = perf_counter()
+        cleared = 0
         for guild in guilds:
-            for member in guild.members:
-                self.database.change_in_member(member, "last_voice_checkpoint", None)
+            self.voice_sessions.clear(guild.id)
+            cleared += self.database.reset_voice_checkpoints(guild.id)
+        return cleared, perf_counter() - start
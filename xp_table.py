@@ -0,0 +1,183 @@
+import mmap
+import os
+import struct
+import sys
+import threading
+from collections.abc import Mapping
+
+HEADER = struct.Struct("<Q")     # number of records in use
+RECORD = struct.Struct("<Qddd")  # member ID, xp, last counted message time, last voice checkpoint (NaN for None)
+VALUE = struct.Struct("<d")
+FIELDS = ["xp", "last_counted_message_time", "last_voice_checkpoint"]
+INITIAL_CAPACITY = 64
+
+def mapped_field(index):
+    """
+    Creates a property that reads and writes one value of a record directly in the mapped file.
+    :param index: The position of the value in RECORD.
+    :return: The property.
+    """
+    return property(lambda record: record.table.read(record.slot, index), lambda record, value: record.table.write(record.slot, index, value))
+
+class MappedRecord(object):
+    __slots__ = ["table", "slot"]
+
+    xp = mapped_field(1)
+    last_counted_message_time = mapped_field(2)
+    last_voice_checkpoint = mapped_field(3)
+
+    def __init__(self, table, slot):
+        """
+        Initializes the MappedRecord, a view of one member's record in an XpTable.
+        It offers the same values as a MemberRecord, but every access goes to the mapped file.
+        :param table: The XpTable the record is stored in.
+        :param slot: The position of the record in the table.
+        """
+        self.table = table
+        self.slot = slot
+
+    def to_dict(self):
+        """
+        Returns the member values as stored in JSON.
+        :return: A dict of member values.
+        """
+        return {key: getattr(self, key) for key in FIELDS}
+
+    def __getitem__(self, key):
+        """
+        Allows reading a value like from a dict, e.g. record["xp"].
+        :param key: The name of the value.
+        :return: The value.
+        """
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        """
+        Allows changing a value like in a dict, e.g. record["xp"] = 5.
+        :param key: The name of the value.
+        :param value: The new value.
+        """
+        setattr(self, key, value)
+
+class XpTable(Mapping):
+    def __init__(self, path):
+        """
+        Initializes the XpTable, the member records of one guild as fixed-width records in a memory-mapped file.
+        Changes are written in place to the mapped pages; an in-memory index maps member IDs to record slots.
+        The table is a read-only mapping of member IDs to MappedRecords; new members are added with insert.
+        :param path: The path of the table file, created if it does not exist.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        if not os.path.exists(path):
+            with open(path, "wb") as handle:
+                handle.write(HEADER.pack(0))
+                handle.truncate(HEADER.size + INITIAL_CAPACITY * RECORD.size)
+        self.handle = open(path, "r+b")
+        self.map = mmap.mmap(self.handle.fileno(), 0)
+        self.count = HEADER.unpack_from(self.map)[0]
+        self.index = {row[0]: slot for slot, row in enumerate(self.scan())}
+
+    def scan(self):
+        """
+        Reads all records in one sequential pass over the mapped file.
+        :return: An iterator of (member_id, xp, last_counted_message_time, last_voice_checkpoint) tuples,
+                 with NaN for a missing voice checkpoint.
+        """
+        return RECORD.iter_unpack(self.map[HEADER.size:HEADER.size + self.count * RECORD.size])
+
+    def read(self, slot, index):
+        """
+        Reads one value of a record.
+        :param slot: The position of the record.
+        :param index: The position of the value in RECORD.
+        :return: The value, None if it is not set.
+        """
+        value = VALUE.unpack_from(self.map, HEADER.size + slot * RECORD.size + index * VALUE.size)[0]
+        return None if value != value else value
+
+    def write(self, slot, index, value):
+        """
+        Writes one value of a record in place.
+        :param slot: The position of the record.
+        :param index: The position of the value in RECORD.
+        :param value: The new value, or None.
+        """
+        VALUE.pack_into(self.map, HEADER.size + slot * RECORD.size + index * VALUE.size, float("nan") if value is None else value)
+
+    def insert(self, member_id, values):
+        """
+        Appends a member record, growing the file when it is full.
+        :param member_id: The ID of the member.
+        :param values: The stored values of the member; missing ones are 0 or None.
+        :return: The new MappedRecord.
+        """
+        if HEADER.size + (self.count + 1) * RECORD.size > len(self.map):
+            with self.lock:
+                self.map.resize(HEADER.size + 2 * max(self.count, INITIAL_CAPACITY) * RECORD.size)
+        slot = self.count
+        checkpoint = values.get("last_voice_checkpoint")
+        RECORD.pack_into(
+            self.map, HEADER.size + slot * RECORD.size, member_id, values.get("xp", 0),
+            values.get("last_counted_message_time", 0), float("nan") if checkpoint is None else checkpoint
+        )
+        self.count += 1
+        HEADER.pack_into(self.map, 0, self.count)
+        self.index[member_id] = slot
+        return MappedRecord(self, slot)
+
+    def estimated_size(self):
+        """
+        Estimates the memory used by the index. The mapped pages belong to the page cache and are not counted.
+        :return: The estimated size in bytes.
+        """
+        size = sys.getsizeof(self) + sys.getsizeof(self.index)
+        for member_id, slot in self.index.items():
+            return size + len(self.index) * (sys.getsizeof(member_id) + sys.getsizeof(slot))
+        return size
+
+    def flush(self):
+        """
+        Writes the changed pages of the mapped file to disk. Safe to call from the writer thread.
+        """
+        with self.lock:
+            self.map.flush()
+
+    def close(self):
+        """
+        Writes the changed pages to disk and unmaps the file.
+        """
+        with self.lock:
+            self.map.flush()
+            self.map.close()
+            self.handle.close()
+
+    def __getitem__(self, member_id):
+        """
+        Retrieves the record of a member.
+        :param member_id: The ID of the member.
+        :return: The MappedRecord.
+        """
+        return MappedRecord(self, self.index[member_id])
+
+    def __contains__(self, member_id):
+        """
+        Checks whether a member has a record.
+        :param member_id: The ID of the member.
+        :return: True if the member has a record.
+        """
+        return member_id in self.index
+
+    def __iter__(self):
+        """
+        Iterates over the member IDs in the order of their records, reading the file sequentially.
+        :return: An iterator of member IDs.
+        """
+        return (row[0] for row in self.scan())
+
+    def __len__(self):
+        """
+        Returns the number of member records.
+        :return: The number of records.
+        """
+        return self.count